@@ -5,8 +5,10 @@ from gemini_integration.gemini import (
 	backfill_embeddings,
 	bulk_embed_files_in_background,
 	generate_chat_response,
+	generate_project_insights,
 	generate_tasks,
 	generate_text,
+	get_conversation_turns,
 	record_feedback,
 )
 from gemini_integration.tools import search_drive as search_google_drive
@@ -124,32 +126,51 @@ def stream_chat(
 @frappe.whitelist()
 @log_activity
 @handle_errors
-def get_project_tasks(project_id, template):
+def get_project_tasks(project_id, template, refresh=False):
 	"""Generates project tasks based on a project ID and template.
 
 	Args:
 	    project_id (str): The ID of the project to generate tasks for.
 	    template (str): The template to use for generating tasks.
+	    refresh (bool, optional): Whether to bypass the cached response. Defaults to False.
 
 	Returns:
 	    list: A list of generated tasks.
 	"""
-	return generate_tasks(project_id, template)
+	return generate_tasks(project_id, template, refresh)
 
 
 @frappe.whitelist()
 @log_activity
 @handle_errors
-def get_project_risks(project_id):
+def get_project_risks(project_id, refresh=False):
 	"""Analyzes and returns the risks for a given project.
 
 	Args:
 	    project_id (str): The ID of the project to analyze.
+	    refresh (bool, optional): Whether to bypass the cached response. Defaults to False.
 
 	Returns:
 	    list: A list of identified risks.
 	"""
-	return analyze_risks(project_id)
+	return analyze_risks(project_id, refresh)
+
+
+@frappe.whitelist()
+@log_activity
+@handle_errors
+def get_project_insights(project_id, template, refresh=False):
+	"""Generates tasks and analyzes risks for a project at the same time.
+
+	Args:
+	    project_id (str): The ID of the project.
+	    template (str): The template to use for generating tasks.
+	    refresh (bool, optional): Whether to bypass the cached responses. Defaults to False.
+
+	Returns:
+	    dict: The generated tasks under "tasks" and the identified risks under "risks".
+	"""
+	return generate_project_insights(project_id, template, refresh)
 
 
 @frappe.whitelist()
@@ -250,12 +271,20 @@ def get_conversation(conversation_id):
 	    conversation_id (str): The ID of the conversation to retrieve.
 
 	Returns:
-	    frappe.model.document.Document: The conversation document.
+	    dict: The conversation's `name`, `title` and `turns`, a list of `role`/`text` dicts.
 	"""
-	doc = frappe.get_doc("Gemini Conversation", conversation_id)
-	if doc.user != frappe.session.user:
+	conversation = frappe.db.get_value(
+		"Gemini Conversation", conversation_id, ["name", "title", "user"], as_dict=True
+	)
+	if not conversation:
+		raise frappe.DoesNotExistError(f"Gemini Conversation {conversation_id} not found")
+	if conversation.user != frappe.session.user:
 		frappe.throw("You are not authorized to view this conversation.")
-	return doc
+	return {
+		"name": conversation.name,
+		"title": conversation.title,
+		"turns": get_conversation_turns(conversation_id),
+	}
 
 
 @frappe.whitelist()
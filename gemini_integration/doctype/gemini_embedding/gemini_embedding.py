@@ -1,9 +1,14 @@
 # Copyright (c) 2024, Sapphire Fountains and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class GeminiEmbedding(Document):
 	pass
+
+
+def on_doctype_update():
+	# Embeddings are replaced and deleted per source document, so index that lookup.
+	frappe.db.add_index("Gemini Embedding", ["ref_doctype", "ref_docname"])
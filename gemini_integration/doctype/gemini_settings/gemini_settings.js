@@ -21,7 +21,17 @@ frappe.ui.form.on("Gemini Settings", {
 		});
 
 		// Listen for real-time events from the background job
+		frappe.realtime.on("embedding_backfill_progress", function (data) {
+			frappe.show_progress(
+				__("Queuing Embeddings"),
+				data.done,
+				data.total,
+				__("{0}: {1} of {2} documents", [data.doctype, data.done, data.total])
+			);
+		});
+
 		frappe.realtime.on("embedding_backfill_complete", function (data) {
+			frappe.hide_progress();
 			frappe.show_alert({
 				message: __(data.message || "Embedding generation complete."),
 				indicator: "green",
@@ -29,6 +39,7 @@ frappe.ui.form.on("Gemini Settings", {
 		});
 
 		frappe.realtime.on("embedding_backfill_failed", function (data) {
+			frappe.hide_progress();
 			frappe.show_alert({
 				message: __(data.error || "An error occurred during embedding generation."),
 				indicator: "red",
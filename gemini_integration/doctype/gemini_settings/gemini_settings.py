@@ -2,6 +2,7 @@
 # For license information, please see license.txt
 
 import frappe
+from frappe import _
 from frappe.model.document import Document
 
 
@@ -12,4 +13,21 @@ class GeminiSettings(Document):
 	including the API key, default model, and other settings.
 	"""
 
-	pass
+	def validate(self):
+		"""Rejects DocTypes for embedding that do not exist."""
+		doctype_names = [link.doctype_name for link in self.get("embedding_doctypes", [])]
+		if not doctype_names:
+			return
+
+		existing = set(frappe.get_all("DocType", filters={"name": ("in", doctype_names)}, pluck="name"))
+		missing = [name for name in doctype_names if name not in existing]
+		if missing:
+			frappe.throw(_("DocTypes for Embedding not found: {0}").format(", ".join(missing)))
+
+	def on_update(self):
+		"""Clears values cached from these settings."""
+		from gemini_integration.gemini import EMBEDDING_DOCTYPES_CACHE_KEY
+		from gemini_integration.utils import bump_settings_version
+
+		frappe.cache().delete_value(EMBEDDING_DOCTYPES_CACHE_KEY)
+		bump_settings_version()
@@ -12,4 +12,14 @@ class GoogleUserToken(Document):
 	allowing the system to make authorized API calls on their behalf.
 	"""
 
-	pass
+	def on_update(self):
+		self.clear_cached_token()
+
+	def on_trash(self):
+		self.clear_cached_token()
+
+	def clear_cached_token(self):
+		from gemini_integration.utils import GOOGLE_CONNECTED_CACHE_KEY, GOOGLE_CREDENTIALS_CACHE_KEY
+
+		frappe.cache().hdel(GOOGLE_CREDENTIALS_CACHE_KEY, self.user)
+		frappe.cache().hdel(GOOGLE_CONNECTED_CACHE_KEY, self.user)
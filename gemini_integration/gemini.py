@@ -1,35 +1,74 @@
 import base64
 import copy
+import functools
+import hashlib
+import itertools
 import json
+import mimetypes
+import os
+import pickle
 import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from types import MappingProxyType
 
 import frappe
 import google.genai as genai
+import numpy as np
+import orjson
 import requests
-from frappe.utils import get_site_url, get_url_to_form
+from frappe.query_builder.functions import Max
+from frappe.utils import cint, create_batch, flt, get_files_path, get_site_url, get_url_to_form, today
 from google.genai import types
 
 # Google API Imports
 from googleapiclient.errors import HttpError
 
 from gemini_integration.tools import (
+	EMBEDDING_DTYPES,
 	create_comment,
 	create_task,
-	fetch_erpnext_data,
+	download_drive_file,
+	find_best_match_for_doctype,
 	get_doc_context,
 	get_drive_file_context,
+	get_drive_file_version,
 	handle_errors,
 	log_activity,
+	pack_embedding,
 	search_calendar,
 	search_drive,
 	search_erpnext_documents,
 	search_files,
 	search_gmail,
 	search_google_contacts,
+	unpack_embedding,
 	update_document_status,
 )
-from gemini_integration.utils import get_gemini_client, generate_embedding, generate_text
+from gemini_integration.utils import (
+	EMBEDDING_BATCH_SIZE,
+	embed_texts,
+	generate_embedding,
+	generate_embeddings,
+	generate_json,
+	generate_text,
+	get_gemini_api_key,
+	get_gemini_client,
+	submit_with_site_context,
+)
+
+# --- MEMOIZED LOOKUPS ---
+# These caches are per process and keyed by site, since one worker can serve several sites.
+
+
+@functools.lru_cache(maxsize=100)
+def _cached_find_doctype(site, doctype_name):
+	"""Memoizes `find_best_match_for_doctype`, which fuzzy-matches against every DocType."""
+	return find_best_match_for_doctype(doctype_name)
+
 
 # --- GEMINI API CONFIGURATION AND BASIC GENERATION ---
 
@@ -83,30 +122,60 @@ def generate_image(prompt):
 
 # --- GOOGLE SERVICE-SPECIFIC FUNCTIONS ---
 
+# Gemini deletes uploaded files after 48 hours; expire cached handles well before that.
+GEMINI_FILE_CACHE_TTL = 40 * 60 * 60
+
 
 @log_activity
 @handle_errors
 def get_drive_file_for_analysis(credentials, file_id):
 	"""Gets a Google Drive file, uploads it to Gemini, and returns the file reference.
 
+	Only the Gemini file handle metadata is cached, never the file content. Handles are
+	keyed by the Drive file's version, so an edited file is uploaded again, and reading
+	the version also confirms the user can still access the file. The entry expires
+	before Gemini deletes the uploaded file, so a cached handle can be reused without
+	re-uploading.
+
 	Args:
 	    credentials (google.oauth2.credentials.Credentials): The user's credentials.
 	    file_id (str): The ID of the Google Drive file.
 
 	Returns:
-	    google.genai.files.File: The uploaded file object, or None on failure.
+	    google.genai.types.Part: A part referencing the uploaded file, or None on failure.
 	"""
 	try:
-		# Get the file content from Google Drive
-		file_content = get_drive_file_context(credentials, file_id)
-
-		if file_content:
+		file_version = get_drive_file_version(file_id, credentials)
+		if not file_version:
+			return None
+
+		cache_key = f"gemini_file_{file_id}_{file_version}"
+		cached_handle = frappe.cache().get_value(cache_key)
+		if cached_handle:
+			return types.Part.from_uri(file_uri=cached_handle["uri"], mime_type=cached_handle["mime_type"])
+
+		# Stream the file content from Google Drive
+		downloaded = download_drive_file(file_id, credentials)
+		if not downloaded:
+			return None
+
+		file_obj, file_name, mime_type = downloaded
+		with file_obj:
 			# Upload the file to Gemini
-			uploaded_file = upload_file_to_gemini(file_id, file_content)
-			if uploaded_file:
-				# Store the file reference in the cache
-				frappe.cache().set_value(f"gemini_file_{file_id}", uploaded_file)
-				return uploaded_file
+			uploaded_file = upload_file_to_gemini(file_name, file_obj, mime_type)
+
+		if uploaded_file:
+			# Store the file handle in the cache
+			frappe.cache().set_value(
+				cache_key,
+				{
+					"name": uploaded_file.name,
+					"uri": uploaded_file.uri,
+					"mime_type": uploaded_file.mime_type,
+				},
+				expires_in_sec=GEMINI_FILE_CACHE_TTL,
+			)
+			return types.Part.from_uri(file_uri=uploaded_file.uri, mime_type=uploaded_file.mime_type)
 	except Exception as e:
 		frappe.log_error(f"Error getting drive file for analysis: {e!s}")
 		return None
@@ -114,22 +183,32 @@ def get_drive_file_for_analysis(credentials, file_id):
 
 @log_activity
 @handle_errors
-def upload_file_to_gemini(file_name, file_content):
+def upload_file_to_gemini(file_name, file_content, mime_type=None):
 	"""Uploads a file to the Gemini API.
 
 	Args:
 	    file_name (str): The name of the file.
-	    file_content (bytes): The content of the file.
+	    file_content (bytes | io.IOBase): The content of the file, either as bytes or
+	        as a readable file-like object which is uploaded without being buffered.
+	    mime_type (str, optional): The MIME type of the file. Defaults to None.
 
 	Returns:
-	    google.genai.files.File: The uploaded file object, or None on failure.
+	    google.genai.types.File: The uploaded file object, or None on failure.
 	"""
 	client = get_gemini_client()
 	if not client:
 		return None
 	try:
+		if isinstance(file_content, bytes):
+			file_content = BytesIO(file_content)
 		# Upload the file to the Gemini API
-		uploaded_file = client.upload_file(display_name=file_name, content=file_content)
+		uploaded_file = client.files.upload(
+			file=file_content,
+			config=types.UploadFileConfig(
+				display_name=file_name,
+				mime_type=mime_type or mimetypes.guess_type(file_name)[0] or "application/octet-stream",
+			),
+		)
 		return uploaded_file
 	except Exception as e:
 		frappe.log_error(f"Gemini File API Error: {e!s}", "Gemini Integration")
@@ -141,35 +220,47 @@ def upload_file_to_gemini(file_name, file_content):
 def get_erpnext_file_content(file_url):
 	"""Gets the content of an ERPNext file.
 
+	Returns the same as `File.get_content()`: files stored on this site are read straight
+	from disk without loading the File document, but only from inside the site's files
+	directory, and text files are decoded just as `File.get_content()` decodes them.
+
 	Args:
 	    file_url (str): The URL of the file in ERPNext.
 
 	Returns:
-	    bytes: The content of the file, or None on failure.
+	    str | bytes: The decoded text of a text file, the bytes of any other file, or
+	        None on failure.
 	"""
 	try:
 		# Get the file from ERPNext
-		file_doc = frappe.get_doc("File", {"file_url": file_url})
-		return file_doc.get_content()
+		file_name = frappe.db.get_value("File", {"file_url": file_url}, "name")
+		if not file_name:
+			raise frappe.DoesNotExistError(f"File {file_url} not found")
+
+		for prefix, is_private in (("/private/files/", True), ("/files/", False)):
+			if file_url.startswith(prefix):
+				files_dir = os.path.realpath(get_files_path(is_private=is_private))
+				file_path = os.path.realpath(os.path.join(files_dir, file_url[len(prefix) :]))
+				if not file_path.startswith(files_dir + os.sep):
+					raise frappe.PermissionError(f"File {file_url} is outside the files directory")
+				with open(file_path, "rb") as f:
+					content = f.read()
+				try:
+					return content.decode()
+				except UnicodeDecodeError:
+					return content
+
+		# Remote file URLs are fetched by the File document itself.
+		return frappe.get_doc("File", file_name).get_content()
 	except Exception as e:
 		frappe.log_error(f"ERPNext File Error: {e!s}", "Gemini Integration")
 		return None
 
 
-def _get_doctype_from_prompt(prompt: str) -> str | None:
-	"""Analyzes a prompt to find the best matching DocType name using keywords.
-
-	Args:
-	    prompt (str): The user's input prompt.
-
-	Returns:
-	    str | None: The best matching DocType name, or None if no clear match is found.
-	"""
-	from gemini_integration.tools import find_best_match_for_doctype
-
-	# A mapping of keywords to the DocType they most likely represent.
-	# The keys are keywords/synonyms, and the values are the official DocType names.
-	doctype_keywords = {
+# A mapping of keywords to the DocType they most likely represent.
+# The keys are keywords/synonyms, and the values are the official DocType names.
+_DOCTYPE_KEYWORDS = MappingProxyType(
+	{
 		"project": "Project",
 		"projects": "Project",
 		"customer": "Customer",
@@ -205,24 +296,62 @@ def _get_doctype_from_prompt(prompt: str) -> str | None:
 		"employee": "Employee",
 		"employees": "Employee",
 	}
+)
+
+# Phrases that ask for a new image rather than for ERPNext data.
+_IMAGE_REQUEST_PHRASES = frozenset(
+	{
+		"generate an image",
+		"generate a picture",
+		"create an image",
+		"create a picture",
+		"make an image",
+		"make a picture",
+		"draw a picture",
+		"draw an image",
+		"draw me",
+	}
+)
+
+# Finds any image request phrase in a single scan of the prompt.
+_IMAGE_REQUEST_RE = re.compile(
+	r"\b(?:" + "|".join(re.escape(phrase) for phrase in sorted(_IMAGE_REQUEST_PHRASES)) + r")\b",
+	re.IGNORECASE,
+)
+
+# One alternation over every keyword, longest first so 'sales orders' wins over 'sales order',
+# finds all keywords in a single scan of the prompt. Word boundaries avoid matching parts of
+# words (e.g., 'so' in 'some').
+_DOCTYPE_KEYWORD_RE = re.compile(
+	r"\b("
+	+ "|".join(re.escape(keyword) for keyword in sorted(_DOCTYPE_KEYWORDS, key=len, reverse=True))
+	+ r")\b",
+	re.IGNORECASE,
+)
+
 
-	# Find all keywords present in the prompt (case-insensitive)
-	found_keywords = []
-	for keyword in doctype_keywords:
-		# Use word boundaries to avoid matching parts of words (e.g., 'so' in 'some')
-		if re.search(rf"\b{re.escape(keyword)}\b", prompt, re.IGNORECASE):
-			found_keywords.append(keyword)
+def _get_doctype_from_prompt(prompt: str) -> str | None:
+	"""Analyzes a prompt to find the best matching DocType name using keywords.
+
+	Args:
+	    prompt (str): The user's input prompt.
 
-	if not found_keywords:
+	Returns:
+	    str | None: The best matching DocType name, or None if no clear match is found.
+	"""
+	# Find all keywords present in the prompt (case-insensitive), in keyword order.
+	prompt_keywords = {match.lower() for match in _DOCTYPE_KEYWORD_RE.findall(prompt)}
+	if not prompt_keywords:
 		return None
+	found_keywords = [keyword for keyword in _DOCTYPE_KEYWORDS if keyword in prompt_keywords]
 
 	# If multiple keywords are found, we could add logic to prioritize.
 	# For now, we'll use the first one found that maps to a valid DocType.
-	for keyword in found_keywords:
-		potential_doctype = doctype_keywords[keyword]
+	# Synonyms such as 'task' and 'tasks' map to the same DocType, so each is only checked once.
+	for potential_doctype in dict.fromkeys(_DOCTYPE_KEYWORDS[keyword] for keyword in found_keywords):
 		# Verify that the mapped DocType actually exists in the system
 		# by calling the tool function directly.
-		matched_doctype = find_best_match_for_doctype(potential_doctype)
+		matched_doctype = _cached_find_doctype(frappe.local.site, potential_doctype)
 		if matched_doctype:
 			return matched_doctype
 
@@ -230,50 +359,135 @@ def _get_doctype_from_prompt(prompt: str) -> str | None:
 
 
 def _uppercase_schema_types(schema):
-	"""Recursively converts all 'type' values in a JSON schema to uppercase."""
-	if isinstance(schema, dict):
-		for key, value in schema.items():
-			if key == "type" and isinstance(value, str):
-				schema[key] = value.upper()
-			else:
-				_uppercase_schema_types(value)
-	elif isinstance(schema, list):
-		for item in schema:
-			_uppercase_schema_types(item)
+	"""Converts all 'type' values in a JSON schema to uppercase, in place.
+
+	The schema is walked with an explicit stack, so deeply nested schemas cost no
+	recursion and only dicts and lists are ever visited.
+	"""
+	stack = [schema]
+	while stack:
+		node = stack.pop()
+		if isinstance(node, dict):
+			for key, value in node.items():
+				if key == "type" and isinstance(value, str):
+					node[key] = value.upper()
+				elif isinstance(value, dict | list):
+					stack.append(value)
+		elif isinstance(node, list):
+			stack.extend(item for item in node if isinstance(item, dict | list))
 	return schema
 
 
+# The sanitized MCP tool declarations, with the registered tool names they were built for.
+_tool_declarations_cache = {"tool_names": None, "declarations": None}
+
+
+def _get_tool_declarations(tool_registry):
+	"""Returns the Gemini tool declarations for every registered MCP tool.
+
+	Tools are only registered when the app is loaded, so the declarations are built once
+	per process and rebuilt only if the set of registered tool names changes.
+
+	Args:
+	    tool_registry (dict): The MCP tool registry.
+
+	Returns:
+	    list: A new list of `types.Tool` declarations that the caller may extend.
+	"""
+	tool_names = tuple(tool_registry)
+	if _tool_declarations_cache["tool_names"] != tool_names:
+		declarations = []
+		for tool_data in tool_registry.values():
+			# Sanitize the tool declaration for the Google API
+			input_schema = tool_data.get("input_schema")
+
+			# Only add the 'parameters' key if the tool has defined properties.
+			if input_schema and input_schema.get("properties"):
+				parameters = {
+					"type": "object",
+					"properties": input_schema.get("properties", {}),
+					"required": input_schema.get("required", []),
+				}
+				function_declaration = types.FunctionDeclaration(
+					name=tool_data.get("name"),
+					description=tool_data.get("description"),
+					parameters_json_schema=_uppercase_schema_types(copy.deepcopy(parameters)),
+				)
+			else:
+				function_declaration = types.FunctionDeclaration(
+					name=tool_data.get("name"),
+					description=tool_data.get("description"),
+				)
+
+			declarations.append(types.Tool(function_declarations=[function_declaration]))
+
+		_tool_declarations_cache["declarations"] = declarations
+		_tool_declarations_cache["tool_names"] = tool_names
+
+	return list(_tool_declarations_cache["declarations"])
+
+
+# This regex looks for patterns like 'PRJ-00001' or 'CUST-00002'.
+_LINKIFY_PATTERN = re.compile(r"(?<!['\"/>])([A-Z]{2,5}-\d{5,})(?!['\"/<])")
+
+
+def _get_linkify_prefix_index():
+	"""Maps each possible document name prefix to the first DocType whose name starts with it.
+
+	This is a heuristic and might need adjustment based on naming series conventions.
+	The index is cached for an hour to balance freshness and performance.
+	"""
+	cache_key = "gemini_linkify_prefix_index"
+	prefix_index = frappe.cache().get_value(cache_key)
+	if not prefix_index:
+		prefix_index = {}
+		for doctype in frappe.get_all("DocType", filters={"issingle": 0}, pluck="name"):
+			upper_name = doctype.upper()
+			for length in range(2, 6):
+				prefix_index.setdefault(upper_name[:length], doctype)
+		frappe.cache().set_value(cache_key, prefix_index, expires_in_sec=3600)
+	return prefix_index
+
+
 def _linkify_erpnext_docs(text):
 	"""Finds potential ERPNext document names in text and replaces them with links."""
-	# This regex looks for patterns like 'PRJ-00001' or 'CUST-00002'.
-	pattern = re.compile(r"(?<!['\"/>])([A-Z]{2,5}-\d{5,})(?!['\"/<])")
-
-	def get_doctypes_from_cache():
-		"""Fetches a list of non-single DocTypes, caching the result."""
-		cache_key = "gemini_linkify_doctypes"
-		doctypes = frappe.cache().get_value(cache_key)
-		if not doctypes:
-			doctypes = frappe.get_all("DocType", filters={"issingle": 0}, pluck="name")
-			# Cache for an hour to balance freshness and performance.
-			frappe.cache().set_value(cache_key, doctypes, expires_in_sec=3600)
-		return doctypes
+	# Every document name we link contains a hyphen, so most chat replies can skip all the work below.
+	if not text or "-" not in text:
+		return text
+
+	doc_names = set(_LINKIFY_PATTERN.findall(text))
+	if not doc_names:
+		return text
+
+	# Resolve each name's DocType, then check which names exist with one query per DocType.
+	prefix_index = _get_linkify_prefix_index()
+	names_by_doctype = {}
+	for doc_name in doc_names:
+		potential_doctype = prefix_index.get(doc_name.split("-")[0])
+		if potential_doctype:
+			names_by_doctype.setdefault(potential_doctype, []).append(doc_name)
+
+	doc_urls = {}
+	for doctype, names in names_by_doctype.items():
+		try:
+			existing_names = frappe.get_all(doctype, filters={"name": ("in", names)}, pluck="name")
+		except Exception:
+			# Virtual DocTypes and DocTypes without a table cannot be queried.
+			continue
+		for doc_name in existing_names:
+			doc_urls[doc_name] = get_url_to_form(doctype, doc_name)
 
-	doctypes_to_check = get_doctypes_from_cache()
+	if not doc_urls:
+		return text
 
 	def replacer(match):
 		doc_name = match.group(1)
-		prefix = doc_name.split("-")[0]
-
-		# This is a heuristic and might need adjustment based on naming series conventions.
-		potential_doctype = next((dt for dt in doctypes_to_check if dt.upper().startswith(prefix)), None)
-
-		if potential_doctype and frappe.db.exists(potential_doctype, doc_name):
-			doc_url = get_url_to_form(potential_doctype, doc_name)
+		doc_url = doc_urls.get(doc_name)
+		if doc_url:
 			return f'<a href="{doc_url}" target="_blank">{doc_name}</a>'
-
 		return doc_name
 
-	return pattern.sub(replacer, text)
+	return _LINKIFY_PATTERN.sub(replacer, text)
 
 
 # --- MAIN CHAT FUNCTIONALITY ---
@@ -320,6 +534,369 @@ SERVICE_TO_TOOL_MAP = {
 }
 
 
+# Tools that call Google APIs on behalf of the user and need a connected account.
+GOOGLE_AUTH_TOOLS = frozenset(
+	{
+		"search_drive",
+		"search_gmail",
+		"search_calendar",
+		"search_google_contacts",
+		"send_email",
+	}
+)
+
+# Tools that create, change, send or delete something. They never start while the plan
+# is still streaming, run on the request's own connection, and are never cached or reused.
+WRITE_TOOLS = frozenset(
+	{
+		"send_email",
+		"create_drive_file",
+		"update_drive_file",
+		"delete_drive_file",
+		"modify_gmail_label",
+		"delete_gmail_message",
+		"create_google_calendar_event",
+		"update_google_calendar_event",
+		"delete_google_calendar_event",
+		"create_comment",
+		"create_task",
+		"update_document_status",
+	}
+)
+
+# How long a planned list of tool calls is reused for an identical prompt.
+PLANNER_CACHE_TTL = 15 * 60
+
+# A cached plan is reused for a differently worded prompt at or above this cosine
+# similarity, and the most recent plans kept per planner context for that comparison.
+PLANNER_SIMILARITY_THRESHOLD = 0.97
+PLANNER_SIMILAR_PLANS_LIMIT = 100
+
+# Upper bound on tool calls from a single plan that run at the same time.
+TOOL_EXECUTION_MAX_WORKERS = 4
+
+# Longest tool result, in characters of JSON, passed to the synthesis call. Larger results
+# are cut so a single broad query cannot crowd the rest of the plan out of the prompt.
+TOOL_RESULT_MAX_CHARS = 20000
+
+# Splits an already generated reply into pieces of a few words for the typewriter effect.
+_STREAM_PIECE_RE = re.compile(r"(?:\S+\s*){1,4}|\s+")
+
+# Pause, in seconds, between pieces of an already generated reply so the chat animates.
+STREAM_PIECE_DELAY = 0.02
+
+
+def _publish_text_in_pieces(text, user):
+	"""Publishes an already generated reply to the chat a few words at a time."""
+	for match in _STREAM_PIECE_RE.finditer(text):
+		frappe.publish_realtime("gemini_chat_update", {"message": match.group()}, user=user)
+		time.sleep(STREAM_PIECE_DELAY)
+
+
+def _truncate_tool_result(tool_result):
+	"""Returns the tool result, or a truncated JSON string of it if it is too long."""
+	if isinstance(tool_result, str):
+		serialized = tool_result
+	elif isinstance(tool_result, int | float | bool) or tool_result is None:
+		return tool_result
+	else:
+		serialized = orjson.dumps(tool_result, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+	if len(serialized) <= TOOL_RESULT_MAX_CHARS:
+		return tool_result
+	omitted = len(serialized) - TOOL_RESULT_MAX_CHARS
+	return f"{serialized[:TOOL_RESULT_MAX_CHARS]}... [truncated {omitted} characters]"
+
+
+def _get_planner_context(model_name, doctype, docname, tool_names, use_google_search, user):
+	"""Joins everything besides the prompt that the planner's output depends on.
+
+	Plans are kept per user, since tools run with that user's data and permissions, and
+	per day, since the planner resolves relative dates such as "last week" into arguments.
+	"""
+	return "|".join(
+		[
+			model_name,
+			",".join(tool_names),
+			str(int(use_google_search)),
+			doctype or "",
+			docname or "",
+			user,
+			today(),
+		]
+	)
+
+
+def _is_cacheable_plan(execution_plan):
+	"""Checks that a plan only reads data, so replaying it cannot repeat a side effect."""
+	for step in execution_plan:
+		if step.get("tool_name") in WRITE_TOOLS:
+			return False
+		args = step.get("args")
+		if isinstance(args, dict) and (args.get("confirmed") or args.get("confirm")):
+			return False
+	return True
+
+
+def _get_planner_cache_key(planner_context, prompt):
+	"""Builds the cache key for an execution plan from everything the planner sees."""
+	key_source = f"{planner_context}|{' '.join(prompt.lower().split())}"
+	return f"gemini_planner:{hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()}"
+
+
+def _get_similar_plans_key(planner_context):
+	"""Builds the cache key for the recent plans made in the same planner context."""
+	return f"gemini_planner_similar:{hashlib.blake2b(planner_context.encode(), digest_size=16).hexdigest()}"
+
+
+def _iter_arg_values(value):
+	"""Yields every value inside a tool argument as text, however deeply nested.
+
+	Booleans and None are skipped, since they are never written out in a prompt.
+	"""
+	if isinstance(value, dict):
+		for item in value.values():
+			yield from _iter_arg_values(item)
+	elif isinstance(value, list | tuple):
+		for item in value:
+			yield from _iter_arg_values(item)
+	elif isinstance(value, bool) or value is None:
+		return
+	elif isinstance(value, float) and value.is_integer():
+		yield str(int(value))
+	else:
+		yield str(value)
+
+
+# A number written in a prompt, such as the 10 in "top 10 customers".
+_PROMPT_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+def _mentions(text, value):
+	"""Checks whether `value` appears in `text` as a whole word, so "10" does not match "100"."""
+	return re.search(rf"(?<!\w){re.escape(value)}(?!\w)", text) is not None
+
+
+def _plan_fits_prompt(execution_plan, planned_prompt, prompt):
+	"""Checks that a plan made for a similar prompt does not carry over its specifics.
+
+	Both prompts must contain the same numbers, and every argument value the planner
+	took from the prompt it was made for, such as a customer name, document ID or limit,
+	must also appear in the new prompt.
+	"""
+	planned_prompt = planned_prompt.lower()
+	prompt = prompt.lower()
+	if set(_PROMPT_NUMBER_RE.findall(planned_prompt)) != set(_PROMPT_NUMBER_RE.findall(prompt)):
+		return False
+	for step in execution_plan:
+		for value in _iter_arg_values(step.get("args")):
+			value = value.strip().lower()
+			if value and _mentions(planned_prompt, value) and not _mentions(prompt, value):
+				return False
+	return True
+
+
+def _find_similar_plan(similar_plans_key, prompt, prompt_embedding):
+	"""Returns a recent plan whose prompt means the same as this one, or None."""
+	similar_plans = [pickle.loads(entry) for entry in frappe.cache().lrange(similar_plans_key, 0, -1)]
+	if not similar_plans:
+		return None
+
+	embeddings = np.frombuffer(
+		b"".join(entry["embedding"] for entry in similar_plans), dtype=np.float32
+	).reshape(len(similar_plans), -1)
+	query = np.asarray(prompt_embedding, dtype=np.float32)
+	scores = embeddings @ (query / np.linalg.norm(query))
+	best = int(np.argmax(scores))
+	if scores[best] < PLANNER_SIMILARITY_THRESHOLD:
+		return None
+
+	entry = similar_plans[best]
+	if not _is_cacheable_plan(entry["plan"]) or not _plan_fits_prompt(entry["plan"], entry["prompt"], prompt):
+		return None
+	return entry["plan"]
+
+
+def _remember_plan(similar_plans_key, prompt, prompt_embedding, execution_plan):
+	"""Adds a read-only plan to the recent plans that similar prompts can reuse.
+
+	The plans are a Redis list that is appended to and trimmed in one transaction, so
+	concurrent turns cannot overwrite each other's entries.
+	"""
+	if not _is_cacheable_plan(execution_plan):
+		return
+
+	embedding = np.asarray(prompt_embedding, dtype=np.float32)
+	entry = {
+		"embedding": (embedding / np.linalg.norm(embedding)).tobytes(),
+		"prompt": prompt,
+		"plan": execution_plan,
+	}
+	cache = frappe.cache()
+	key = cache.make_key(similar_plans_key)
+	pipeline = cache.pipeline()
+	pipeline.rpush(key, pickle.dumps(entry))
+	pipeline.ltrim(key, -PLANNER_SIMILAR_PLANS_LIMIT, -1)
+	pipeline.expire(key, PLANNER_CACHE_TTL)
+	pipeline.execute()
+
+
+# Decodes one JSON value at a time out of a partially streamed planner response.
+_PLAN_DECODER = json.JSONDecoder()
+
+# Whitespace and commas between the steps of a JSON plan.
+_PLAN_SEPARATOR_RE = re.compile(r"[\s,]*")
+
+
+def _decode_plan_steps(text, position):
+	"""Decodes the steps that are already complete in a partially streamed JSON plan.
+
+	Args:
+		text (str): The planner text received so far.
+		position (int): The offset to resume decoding from, or 0 before the first step.
+
+	Returns:
+		tuple: ``(steps, position)`` with the newly completed steps and the offset to
+			resume from. The offset is -1 once the text is known not to be a JSON list.
+	"""
+	if position == 0:
+		stripped = text.lstrip()
+		if not stripped:
+			return [], 0
+		if not stripped.startswith("["):
+			return [], -1
+		position = len(text) - len(stripped) + 1
+
+	steps = []
+	while True:
+		position = _PLAN_SEPARATOR_RE.match(text, position).end()
+		if position >= len(text) or text[position] == "]":
+			break
+		try:
+			step, position = _PLAN_DECODER.raw_decode(text, position)
+		except json.JSONDecodeError:
+			# The rest of this step has not been streamed yet.
+			break
+		if isinstance(step, dict):
+			steps.append(step)
+	return steps, position
+
+
+def _stream_planner_response(client, model_name, contents, planner_config_args):
+	"""Yields the planner response chunks, retrying on a model that supports tools."""
+	config = types.GenerateContentConfig(
+		tools=planner_config_args.get("tools"),
+		tool_config=planner_config_args.get("tool_config"),
+		system_instruction=planner_config_args.get("system_instruction"),
+	)
+	response = client.models.generate_content_stream(model=model_name, contents=contents, config=config)
+	try:
+		first_chunk = next(response, None)
+	except Exception as e:
+		if "unsupported" in str(e).lower() and "tool" in str(e).lower():
+			frappe.log(
+				f"Model {model_name} does not support tools. Falling back to gemini-2.5-pro for planning phase."
+			)
+			response = client.models.generate_content_stream(
+				model="gemini-2.5-pro", contents=contents, config=config
+			)
+			first_chunk = next(response, None)
+		else:
+			raise e
+
+	if first_chunk is not None:
+		yield first_chunk
+	yield from response
+
+
+def _run_planner(client, model_name, prompt, planner_config_args, user=None, on_step=None):
+	"""Asks the model to plan tool calls for a prompt.
+
+	The planner response is streamed, and every step is passed to ``on_step`` as soon
+	as it is complete so its tool can start while the rest of the plan is generated.
+
+	Args:
+		on_step (callable, optional): Called with each ``{"tool_name": ..., "args": {...}}``
+			step as it arrives. Steps may be repeated; the callback must ignore duplicates.
+
+	Returns:
+		tuple: ``(execution_plan, planner_response_text)``. ``execution_plan`` is a
+			non-empty list of ``{"tool_name": ..., "args": {...}}`` steps, or None when
+			the model answered the prompt directly in ``planner_response_text``.
+	"""
+	on_step = on_step or (lambda step: None)
+
+	# The 'thinking_config' is not passed to the planner call; combining it with tool usage
+	# fails with INVALID_ARGUMENT. The 'show_thinking' feature only applies to the synthesis call.
+	planner_text = StringIO()
+	tool_calls = []
+	plan_position = 0
+	maps_widget_published = False
+	for chunk in _stream_planner_response(client, model_name, [prompt], planner_config_args):
+		if not chunk.candidates:
+			continue
+		candidate = chunk.candidates[0]
+
+		grounding_metadata = candidate.grounding_metadata
+		if (
+			grounding_metadata
+			and grounding_metadata.google_maps_widget_context_token
+			and not maps_widget_published
+		):
+			maps_widget_published = True
+			frappe.publish_realtime(
+				"gemini_chat_update",
+				{
+					"map_widget_token": grounding_metadata.google_maps_widget_context_token,
+					"sources": [
+						{"title": c.maps.title, "uri": c.maps.uri}
+						for c in grounding_metadata.grounding_chunks
+					],
+				},
+				user=user,
+			)
+
+		# The planner may request several tool calls at once, each arriving as a complete part.
+		for part in (candidate.content and candidate.content.parts) or []:
+			if part.function_call:
+				step = {"tool_name": part.function_call.name, "args": dict(part.function_call.args or {})}
+				tool_calls.append(step)
+				on_step(step)
+			elif part.text and not part.thought:
+				planner_text.write(part.text)
+
+		if plan_position != -1 and not tool_calls:
+			# Start the steps of a JSON plan as each one is complete.
+			steps, plan_position = _decode_plan_steps(planner_text.getvalue(), plan_position)
+			for step in steps:
+				on_step(step)
+
+	planner_response_text = planner_text.getvalue()
+
+	# --- 2. Parse Planner Response ---
+	# Direct function calls are the most likely alternative to a JSON plan.
+	if tool_calls:
+		frappe.log(f"Planner returned function calls: {', '.join(step['tool_name'] for step in tool_calls)}")
+		return tool_calls, planner_response_text
+
+	# If there's no function call, check for a JSON plan or a direct text response.
+	try:
+		# A valid plan is a parsable JSON string that is a non-empty list.
+		execution_plan = json.loads(planner_response_text)
+		if not isinstance(execution_plan, list) or not execution_plan:
+			# If it's an empty list `[]` or not a list, treat it as a direct response.
+			execution_plan = None
+	except (json.JSONDecodeError, ValueError):
+		# The response is not a valid JSON plan, so it's the final answer.
+		execution_plan = None
+
+	# Pass on any steps the incremental decoder could not see, such as in a non-list plan.
+	for step in execution_plan or []:
+		if isinstance(step, dict):
+			on_step(step)
+	return execution_plan, planner_response_text
+
+
 @log_activity
 @handle_errors
 def generate_chat_response(
@@ -357,87 +934,57 @@ def generate_chat_response(
 			or None for streaming calls (which use WebSockets).
 	"""
 	# --- 0. Setup and Configuration ---
-	settings = frappe.get_single("Gemini Settings")
+	settings = frappe.get_cached_doc("Gemini Settings")
 	show_thinking = settings.get("show_thinking", 0)
 
-	api_key = settings.get_password("api_key")
+	api_key = get_gemini_api_key()
 	if not api_key:
 		frappe.throw("Gemini API Key not found. Please configure it in Gemini Settings.")
 
 	from gemini_integration.mcp import mcp
-	from gemini_integration.utils import is_google_integrated
 
 	model_name = model or settings.default_model or "gemini-3-pro-preview"
-	# Load conversation history
-	conversation_history = []
-	if conversation_id:
-		try:
-			conversation_doc = frappe.get_doc("Gemini Conversation", conversation_id)
-			if conversation_doc.conversation:
-				conversation_history = json.loads(conversation_doc.conversation)
-		except frappe.DoesNotExistError:
-			conversation_id = None
-
-	# For streaming, ensure a conversation ID exists to send back to the client
+	# Turns are appended to the conversation on save, so prior history never has to be loaded here.
+	if conversation_id and not frappe.db.exists("Gemini Conversation", conversation_id):
+		conversation_id = None
+
+	# For streaming, ensure a conversation ID exists to send back to the client.
+	# Streaming runs as a background job that only commits when it ends, so each save on
+	# this path is committed before the client is told about it and reloads the sidebar
+	# or sends its next message; this also releases the conversation row lock.
 	if stream and not conversation_id:
 		conversation_id = save_conversation(None, prompt, [], user=user)
+		frappe.db.commit()
 		frappe.publish_realtime("gemini_chat_update", {"conversation_id": conversation_id}, user=user)
 
+	# Image requests go straight to the image model without a planner round-trip.
+	if _IMAGE_REQUEST_RE.search(prompt):
+		image_url = generate_image(prompt)
+		response_text = f"![{prompt}]({image_url})" if image_url else "I was unable to generate an image."
+		save_conversation(
+			conversation_id,
+			prompt,
+			[{"role": "user", "text": prompt}, {"role": "gemini", "text": response_text}],
+			user=user,
+		)
+		if stream:
+			frappe.db.commit()
+			frappe.publish_realtime("gemini_chat_update", {"message": response_text}, user=user)
+			frappe.publish_realtime("gemini_chat_update", {"end_of_stream": True}, user=user)
+			return
+		return {
+			"response": response_text,
+			"thoughts": "The prompt asked for an image, so it was sent to the image model.",
+			"conversation_id": conversation_id,
+		}
+
 	# --- 1. Planning Phase ---
 	# Provide the model with a "menu" of all available tools.
-	tool_declarations = []
-	for _tool_name, tool_data in mcp._tool_registry.items():
-		# Sanitize the tool declaration for the Google API
-		input_schema = tool_data.get("input_schema")
-
-		# Only add the 'parameters' key if the tool has defined properties.
-		if input_schema and input_schema.get("properties"):
-			parameters = {
-				"type": "object",
-				"properties": input_schema.get("properties", {}),
-				"required": input_schema.get("required", []),
-			}
-			function_declaration = types.FunctionDeclaration(
-				name=tool_data.get("name"),
-				description=tool_data.get("description"),
-				parameters_json_schema=_uppercase_schema_types(parameters),
-			)
-		else:
-			function_declaration = types.FunctionDeclaration(
-				name=tool_data.get("name"),
-				description=tool_data.get("description"),
-			)
-
-		tool_declarations.append(types.Tool(function_declarations=[function_declaration]))
+	tool_declarations = _get_tool_declarations(mcp._tool_registry)
 
 	if settings.enable_google_search and use_google_search:
 		tool_declarations.append(types.Tool(google_search=types.GoogleSearch()))
 
-	tool_config = {"function_calling_config": {"mode": "ANY"}}
-	if settings.enable_google_maps_grounding:
-		tool_declarations.append(types.Tool(google_maps=types.GoogleMaps(enable_widget=True)))
-		if manual_location:
-			from geopy.geocoders import Nominatim
-
-			geolocator = Nominatim(user_agent="gemini_integration")
-			location = geolocator.geocode(manual_location)
-			if location:
-				latitude = location.latitude
-				longitude = location.longitude
-			else:
-				frappe.publish_realtime(
-					"gemini_chat_update",
-					{"message": f"Could not find a location for '{manual_location}'."},
-					user=user,
-				)
-				frappe.publish_realtime("gemini_chat_update", {"end_of_stream": True}, user=user)
-				return
-
-		if latitude and longitude:
-			tool_config["retrieval_config"] = types.RetrievalConfig(
-				lat_lng=types.LatLng(latitude=latitude, longitude=longitude)
-			)
-
 	# Craft the "Planner" instruction
 	planning_instruction = """
 You are a planner for an AI assistant integrated into ERPNext. Your job is to analyze the user's prompt and the list of available tools.
@@ -482,137 +1029,86 @@ If no tools are needed for the prompt, respond with a friendly, conversational a
 	if show_thinking:
 		planner_config_args["thinking_config"] = types.ThinkingConfig(include_thoughts=True)
 
-	# --- 1a. Planning Phase (Non-Streaming) ---
-	# Use the non-streaming client for the planning phase as tool use is not supported with streaming.
+	# --- 1a. Planning Phase ---
 	client = get_gemini_client()
 	if not client:
 		frappe.throw("Gemini integration is not configured. Please set the API Key in Gemini Settings.")
 
-	model_contents = [prompt]
-
-	# The 'thinking_config' implies a streaming response, which conflicts with tool usage.
-	# We explicitly do not add it to the planner call to avoid the INVALID_ARGUMENT error.
-	# The 'show_thinking' feature will only apply to the final synthesis call, which is streamed.
-
-	# Refactored to use the client.models.generate_content method, which correctly handles tools.
-	try:
-		planner_response = client.models.generate_content(
-			model=model_name,
-			contents=model_contents,
-			config=types.GenerateContentConfig(
-				tools=planner_config_args.get("tools"),
-				tool_config=planner_config_args.get("tool_config"),
-				system_instruction=planner_config_args.get("system_instruction"),
-			),
+	# Plans only depend on the prompt, the viewed document, the available tools, the user
+	# and the day, so repeated prompts reuse a cached plan. Maps grounding is
+	# location-specific and publishes widget data from the planner response, so it always
+	# runs the planner. Plans that write anything are never cached.
+	planner_cache_key = None
+	similar_plans_key = None
+	if not settings.enable_google_maps_grounding:
+		planner_context = _get_planner_context(
+			model_name,
+			doctype,
+			docname,
+			tuple(sorted(mcp._tool_registry)),
+			bool(settings.enable_google_search and use_google_search),
+			user or frappe.session.user,
 		)
-	except Exception as e:
-		if "unsupported" in str(e).lower() and "tool" in str(e).lower():
-			frappe.log(f"Model {model_name} does not support tools. Falling back to gemini-2.5-pro for planning phase.")
-			planner_response = client.models.generate_content(
-				model="gemini-2.5-pro",
-				contents=model_contents,
-				config=types.GenerateContentConfig(
-					tools=planner_config_args.get("tools"),
-					tool_config=planner_config_args.get("tool_config"),
-					system_instruction=planner_config_args.get("system_instruction"),
-				),
-			)
-		else:
-			raise e
+		planner_cache_key = _get_planner_cache_key(planner_context, prompt)
+		similar_plans_key = _get_similar_plans_key(planner_context)
 
-	# --- 1b. Process Planner Response ---
 	planner_response_text = ""
-	tool_call = None
-
-	# Non-streaming response handling
-	if planner_response.candidates[0].grounding_metadata:
-		grounding_metadata = planner_response.candidates[0].grounding_metadata
-		if grounding_metadata.google_maps_widget_context_token:
-			frappe.publish_realtime(
-				"gemini_chat_update",
-				{
-					"map_widget_token": grounding_metadata.google_maps_widget_context_token,
-					"sources": [
-						{"title": c.maps.title, "uri": c.maps.uri} for c in grounding_metadata.grounding_chunks
-					],
-				},
-				user=user,
-			)
-	# Safely access the text part of the response
-	try:
-		planner_response_text = planner_response.text
-	except ValueError:
-		# This can happen if the response is only a tool call and has no text part.
-		planner_response_text = ""
-
-
-	# Check for a tool call in the response parts
-	for part in planner_response.candidates[0].content.parts:
-		if hasattr(part, "function_call"):
-			tool_call = part.function_call
-			break
-
-	# --- 2. Parse Planner Response ---
-	execution_plan = None
-	direct_response = False
-
-	# Check for a direct function call first. This is the most likely alternative to a JSON plan.
-	if tool_call:
-		# Adapt the single tool call to the list format expected by the execution phase.
-		execution_plan = [
-			{
-				"tool_name": tool_call.name,
-				"args": {k: v for k, v in tool_call.args.items()},
-			}
-		]
-		frappe.log(f"Planner returned a direct function call: {tool_call.name}")
+	prompt_embedding = None
+	execution_plan = frappe.cache().get_value(planner_cache_key) if planner_cache_key else None
+	if not execution_plan and similar_plans_key:
+		# An embedding call is far cheaper than a planner call, so check whether a
+		# differently worded prompt with the same meaning was planned recently.
+		prompt_embedding = generate_embedding(prompt)
+		if prompt_embedding:
+			execution_plan = _find_similar_plan(similar_plans_key, prompt, prompt_embedding)
+			if execution_plan:
+				frappe.cache().set_value(planner_cache_key, execution_plan, expires_in_sec=PLANNER_CACHE_TTL)
+
+	plan_execution = _PlanExecution(mcp._tool_registry)
+	if execution_plan:
+		frappe.log("Reusing a cached execution plan for this prompt.")
 	else:
-		# If there's no function call, proceed to check for a JSON plan or a direct text response.
-		try:
-			# A valid plan is a parsable JSON string that is a non-empty list.
-			execution_plan = json.loads(planner_response_text)
-			if not isinstance(execution_plan, list) or not execution_plan:
-				# If it's an empty list `[]` or not a list, treat it as a direct response.
-				direct_response = True
-				execution_plan = None
-		except (json.JSONDecodeError, ValueError):
-			# The response is not a valid JSON plan, so it's the final answer.
-			direct_response = True
-			execution_plan = None
+		# Read-only tools start running while the planner is still streaming the rest of the plan.
+		execution_plan, planner_response_text = _run_planner(
+			client, model_name, prompt, planner_config_args, user=user, on_step=plan_execution.add
+		)
+		if execution_plan and planner_cache_key and _is_cacheable_plan(execution_plan):
+			frappe.cache().set_value(planner_cache_key, execution_plan, expires_in_sec=PLANNER_CACHE_TTL)
+			if prompt_embedding:
+				_remember_plan(similar_plans_key, prompt, prompt_embedding, execution_plan)
+
+	direct_response = not execution_plan
+	if execution_plan:
+		plan_execution.set_plan(execution_plan)
 
 	# If it was determined to be a direct response, handle it and exit.
 	if direct_response:
+		# Wait for any steps started from text that turned out not to be a plan.
+		plan_execution.close()
 		# If we have a direct answer, we process it and exit.
 		final_response_text = _linkify_erpnext_docs(planner_response_text)
 
-		# If streaming, we still want the typewriter effect.
-		# We'll initiate a new, simple streaming call to deliver the response.
+		# The answer is already complete, so it is replayed in small pieces for the
+		# typewriter effect instead of asking the model to repeat it.
 		if stream:
-			# This prompt is designed to make the model simply repeat the text.
-			streaming_prompt = f"Please present the following text to the user. Do not add any extra commentary, just provide the text as is:\n\n---\n\n{final_response_text}"
-			direct_stream = client.models.generate_content_stream(
-				model=model_name,
-				contents=streaming_prompt,
+			save_conversation(
+				conversation_id,
+				prompt,
+				[{"role": "user", "text": prompt}, {"role": "gemini", "text": final_response_text}],
+				user=user,
 			)
-
-			streamed_text_to_save = ""
-			for chunk in direct_stream:
-				if chunk.text:
-					text_chunk = chunk.text
-					streamed_text_to_save += text_chunk
-					frappe.publish_realtime("gemini_chat_update", {"message": text_chunk}, user=user)
-
-			# Save the final, streamed text to the conversation history
-			conversation_history.append({"role": "user", "text": prompt})
-			conversation_history.append({"role": "gemini", "text": streamed_text_to_save})
-			save_conversation(conversation_id, prompt, conversation_history, user=user)
+			frappe.db.commit()
+			_publish_text_in_pieces(final_response_text, user)
 			frappe.publish_realtime("gemini_chat_update", {"end_of_stream": True}, user=user)
 			return
 
 		# For non-streaming, save and return the final payload directly.
-		conversation_history.append({"role": "user", "text": prompt})
-		conversation_history.append({"role": "gemini", "text": final_response_text})
-		save_conversation(conversation_id, prompt, conversation_history, user=user)
+		save_conversation(
+			conversation_id,
+			prompt,
+			[{"role": "user", "text": prompt}, {"role": "gemini", "text": final_response_text}],
+			user=user,
+		)
 		return {
 			"response": final_response_text,
 			"thoughts": "The model provided a direct answer without using tools.",
@@ -620,57 +1116,8 @@ If no tools are needed for the prompt, respond with a friendly, conversational a
 		}
 
 	# --- 3. Execution Phase ---
-	compiled_context = []
-
-	# Iterate over the execution plan, which is now guaranteed to be a list of dicts
-	# (or None/Empty, in which case the loop won't run)
-	if execution_plan:
-		for step in execution_plan:
-			tool_name = step.get("tool_name")
-			tool_args = step.get("args", {})
-
-			if not tool_name:
-				continue
-
-			if not isinstance(tool_args, dict):
-				tool_args = {}
-
-			# Check for Google authentication if a Google tool is planned
-			if tool_name in [
-				"search_drive",
-				"search_gmail",
-				"search_calendar",
-				"search_google_contacts",
-				"send_email",
-			]:
-				if not is_google_integrated():
-					compiled_context.append(
-						{
-							"tool_name": tool_name,
-							"status": "error",
-							"result": "User has not connected their Google account.",
-						}
-					)
-					continue  # Skip to the next tool in the plan
+	compiled_context = plan_execution.collect()
 
-		try:
-			# Execute the tool function
-			tool_function = mcp._tool_registry[tool_name]["fn"]
-			tool_result = tool_function(**tool_args)
-			compiled_context.append(
-				types.Part.from_function_response(name=tool_name, response={"result": tool_result})
-			)
-		except Exception as e:
-			frappe.log_error(
-				message=f"Error executing tool '{tool_name}' from plan: {e!s}\n{frappe.get_traceback()}",
-				title="Gemini Execution Phase Error",
-			)
-			compiled_context.append(
-				types.Part.from_function_response(
-					name=tool_name,
-					response={"error": f"An error occurred while running the tool: {e!s}"},
-				)
-			)
 	# --- 4. Synthesis Phase ---
 	if stream:
 		final_response = client.models.generate_content_stream(
@@ -683,19 +1130,35 @@ If no tools are needed for the prompt, respond with a friendly, conversational a
 			contents=compiled_context,
 		)
 	if stream:
-		final_response_text = ""
+		response_parts = []
+		pending_text = ""
 		for chunk in final_response:
 			if hasattr(chunk, "thought") and chunk.thought:
 				frappe.publish_realtime("gemini_chat_thought", {"thought": chunk.text}, user=user)
 			elif chunk.text:
-				text_chunk = chunk.text
-				final_response_text += text_chunk
-				frappe.publish_realtime("gemini_chat_update", {"message": text_chunk}, user=user)
-
-		final_response_text = _linkify_erpnext_docs(final_response_text)
-		conversation_history.append({"role": "user", "text": prompt})
-		conversation_history.append({"role": "gemini", "text": final_response_text})
-		save_conversation(conversation_id, prompt, conversation_history, user=user)
+				# Document names never contain whitespace, so everything up to the last
+				# whitespace can be linked and sent now; only the trailing word is held back.
+				pending_text += chunk.text
+				boundary = max(pending_text.rfind(" "), pending_text.rfind("\n")) + 1
+				if boundary:
+					text_chunk = _linkify_erpnext_docs(pending_text[:boundary])
+					pending_text = pending_text[boundary:]
+					response_parts.append(text_chunk)
+					frappe.publish_realtime("gemini_chat_update", {"message": text_chunk}, user=user)
+
+		if pending_text:
+			text_chunk = _linkify_erpnext_docs(pending_text)
+			response_parts.append(text_chunk)
+			frappe.publish_realtime("gemini_chat_update", {"message": text_chunk}, user=user)
+
+		final_response_text = "".join(response_parts)
+		save_conversation(
+			conversation_id,
+			prompt,
+			[{"role": "user", "text": prompt}, {"role": "gemini", "text": final_response_text}],
+			user=user,
+		)
+		frappe.db.commit()
 		frappe.publish_realtime("gemini_chat_update", {"end_of_stream": True}, user=user)
 		return
 
@@ -705,9 +1168,12 @@ If no tools are needed for the prompt, respond with a friendly, conversational a
 	except (AttributeError, ValueError):
 		# Handle cases where the response might not have a .text attribute (e.g., error, safety)
 		final_response_text = "I am unable to provide a response at this time."
-	conversation_history.append({"role": "user", "text": prompt})
-	conversation_history.append({"role": "gemini", "text": final_response_text})
-	save_conversation(conversation_id, prompt, conversation_history, user=user)
+	save_conversation(
+		conversation_id,
+		prompt,
+		[{"role": "user", "text": prompt}, {"role": "gemini", "text": final_response_text}],
+		user=user,
+	)
 
 	return {
 		"response": final_response_text,
@@ -716,13 +1182,187 @@ If no tools are needed for the prompt, respond with a friendly, conversational a
 	}
 
 
-def save_conversation(conversation_id, title, conversation, user=None):
-	"""Saves or updates a conversation in the database.
+class _PlanExecution:
+	"""Runs the planned tool calls and collects their results as function-response parts.
+
+	Identical read-only calls are executed only once, and independent calls run
+	concurrently since most tools wait on Google or database I/O. Read-only steps can be
+	started while the planner is still streaming the rest of the plan. Steps for
+	`WRITE_TOOLS` are only taken from the complete plan passed to `set_plan`, keyed by
+	their position so a repeated write runs once per occurrence, and run inline on the
+	request's own connection. Results keep the plan order.
+
+	Args:
+		tool_registry (dict): The MCP tool registry to resolve tool names against.
+	"""
+
+	def __init__(self, tool_registry):
+		self.tool_registry = tool_registry
+		self.steps = {}
+		self.order = []
+		self.results = {}
+		self.futures = {}
+		self.pending = []
+		self.executor = None
+		self.google_integrated = None
+
+	def add(self, step, start=True, position=None):
+		"""Adds a ``{"tool_name": ..., "args": {...}}`` step, starting it unless ``start`` is False.
+
+		Write steps are ignored unless ``position``, their index in the complete plan, is given.
+
+		Returns:
+			tuple: The key the step's result is stored under, or None if it was ignored.
+		"""
+		tool_name = step.get("tool_name")
+		if not tool_name:
+			return None
+
+		tool_args = step.get("args", {})
+		if not isinstance(tool_args, dict):
+			tool_args = {}
+
+		if tool_name in WRITE_TOOLS:
+			# Streamed steps may be delivered again, so a write is only known to be a
+			# separate call from its place in the complete plan.
+			if position is None:
+				return None
+			step_key = (tool_name, position)
+		else:
+			step_key = (
+				tool_name,
+				orjson.dumps(tool_args, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS),
+			)
+		if step_key in self.steps:
+			return step_key
+		self.steps[step_key] = (tool_name, tool_args)
+
+		# Check for Google authentication if a Google tool is planned
+		if tool_name in GOOGLE_AUTH_TOOLS:
+			if self.google_integrated is None:
+				from gemini_integration.utils import is_google_integrated
+
+				self.google_integrated = is_google_integrated()
+			if not self.google_integrated:
+				self.results[step_key] = types.Part.from_function_response(
+					name=tool_name, response={"error": "User has not connected their Google account."}
+				)
+				return step_key
+
+		if start and tool_name not in WRITE_TOOLS:
+			self._submit(step_key)
+		else:
+			self.pending.append(step_key)
+		return step_key
+
+	def set_plan(self, execution_plan):
+		"""Adds every step of the complete plan, whose order the collected results follow."""
+		for position, step in enumerate(execution_plan):
+			if isinstance(step, dict):
+				step_key = self.add(step, start=False, position=position)
+				if step_key and step_key not in self.order:
+					self.order.append(step_key)
+
+	def collect(self):
+		"""Runs any steps not started yet, waits for all of them and returns their results.
+
+		Returns:
+			list: A list of `types.Part` function responses, one per unique tool call.
+		"""
+		pending, self.pending = self.pending, []
+		writes = [step_key for step_key in pending if step_key[0] in WRITE_TOOLS]
+		reads = [step_key for step_key in pending if step_key[0] not in WRITE_TOOLS]
+		if len(reads) == 1 and not self.executor:
+			# A single call gains nothing from a thread and its own database connection.
+			self.results[reads[0]] = self._run_tool(*self.steps[reads[0]])
+		else:
+			for step_key in reads:
+				self._submit(step_key)
+
+		# Writes belong to the request's transaction, so they are never moved to a worker.
+		for step_key in writes:
+			self.results[step_key] = self._run_tool(*self.steps[step_key])
+
+		for step_key, future in self.futures.items():
+			try:
+				self.results[step_key] = future.result()
+			except Exception as e:
+				# _run_tool handles tool errors itself; this is a failure to set up the
+				# worker's site context, which should not sink the other calls.
+				tool_name = self.steps[step_key][0]
+				frappe.log_error(
+					message=f"Error starting tool '{tool_name}' from plan: {e!s}\n{frappe.get_traceback()}",
+					title="Gemini Execution Phase Error",
+				)
+				self.results[step_key] = types.Part.from_function_response(
+					name=tool_name,
+					response={"error": f"An error occurred while running the tool: {e!s}"},
+				)
+		self.close()
+		return [self.results[step_key] for step_key in self.order]
+
+	def close(self):
+		"""Waits for the started calls and releases the worker threads.
+
+		Steps that were never started, including every write, are dropped.
+		"""
+		if self.executor:
+			self.executor.shutdown(wait=True)
+			self.executor = None
+
+	def _submit(self, step_key):
+		if not self.executor:
+			self.executor = ThreadPoolExecutor(max_workers=TOOL_EXECUTION_MAX_WORKERS)
+		self.futures[step_key] = submit_with_site_context(
+			self.executor, self._run_tool, *self.steps[step_key]
+		)
+
+	def _run_tool(self, tool_name, tool_args):
+		try:
+			# Execute the tool function
+			tool_result = self.tool_registry[tool_name]["fn"](**tool_args)
+			return types.Part.from_function_response(
+				name=tool_name, response={"result": _truncate_tool_result(tool_result)}
+			)
+		except Exception as e:
+			frappe.log_error(
+				message=f"Error executing tool '{tool_name}' from plan: {e!s}\n{frappe.get_traceback()}",
+				title="Gemini Execution Phase Error",
+			)
+			return types.Part.from_function_response(
+				name=tool_name,
+				response={"error": f"An error occurred while running the tool: {e!s}"},
+			)
+
+
+# Column order used when bulk-inserting Gemini Conversation Turn rows.
+CONVERSATION_TURN_INSERT_FIELDS = (
+	"name",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"parent",
+	"parenttype",
+	"parentfield",
+	"idx",
+	"role",
+	"text",
+)
+
+
+def save_conversation(conversation_id, title, new_turns, user=None):
+	"""Appends new turns to a conversation, creating the conversation if needed.
+
+	Turns are stored as rows of the `Gemini Conversation Turn` child table and are
+	only ever inserted, so saving a turn never rewrites the earlier history. Nothing is
+	committed here; a request commits when it ends, and the streaming chat job commits
+	after each save before publishing to the client.
 
 	Args:
 	    conversation_id (str): The ID of the conversation to update, or None to create a new one.
 	    title (str): The title of the conversation.
-	    conversation (list): The list of conversation entries.
+	    new_turns (list): The conversation entries (dicts with `role` and `text`) to append.
 	    user (str, optional): The user to assign the conversation to if creating a new one.
 	        Defaults to the current session user.
 
@@ -730,18 +1370,88 @@ def save_conversation(conversation_id, title, conversation, user=None):
 	    str: The name of the saved conversation document.
 	"""
 	if not conversation_id:
-		# Create a new conversation
 		doc = frappe.new_doc("Gemini Conversation")
 		doc.title = title[:140]
 		doc.user = user or frappe.session.user
-	else:
-		# Update an existing conversation
-		doc = frappe.get_doc("Gemini Conversation", conversation_id)
+		for turn in new_turns:
+			doc.append("turns", {"role": turn["role"], "text": turn["text"]})
+		doc.save(ignore_permissions=True)
+		return doc.name
+
+	if not new_turns:
+		return conversation_id
+
+	# Lock the conversation so concurrent turns take consecutive `idx` values, reading the
+	# legacy JSON blob in the same query.
+	legacy_blob = frappe.db.get_value("Gemini Conversation", conversation_id, "conversation", for_update=True)
+	turn = frappe.qb.DocType("Gemini Conversation Turn")
+	start_idx = (
+		frappe.qb.from_(turn)
+		.select(Max(turn.idx))
+		.where(
+			(turn.parent == conversation_id)
+			& (turn.parenttype == "Gemini Conversation")
+			& (turn.parentfield == "turns")
+		)
+	).run()[0][0] or 0
+
+	parent_values = {}
+	if legacy_blob:
+		# Conversations saved before turns were stored as rows only have the JSON blob;
+		# move that history into the table alongside the appended turns and clear it.
+		if not start_idx:
+			new_turns = orjson.loads(legacy_blob) + list(new_turns)
+		parent_values["conversation"] = None
+
+	now = frappe.utils.now()
+	owner = user or frappe.session.user
+	frappe.db.bulk_insert(
+		"Gemini Conversation Turn",
+		fields=CONVERSATION_TURN_INSERT_FIELDS,
+		values=[
+			(
+				frappe.generate_hash(length=10),
+				now,
+				now,
+				owner,
+				owner,
+				conversation_id,
+				"Gemini Conversation",
+				"turns",
+				start_idx + i,
+				turn["role"],
+				turn["text"],
+			)
+			for i, turn in enumerate(new_turns, start=1)
+		],
+	)
+	# Touch the parent so the conversation list stays ordered by latest activity.
+	parent_values["modified"] = now
+	frappe.db.set_value("Gemini Conversation", conversation_id, parent_values, update_modified=False)
+	return conversation_id
 
-	doc.conversation = json.dumps(conversation)
-	doc.save(ignore_permissions=True)
-	frappe.db.commit()
-	return doc.name
+
+def get_conversation_turns(conversation_id):
+	"""Returns the history of a conversation as a list of `role`/`text` dicts.
+
+	Args:
+	    conversation_id (str): The ID of the conversation.
+
+	Returns:
+	    list: The conversation entries in order, falling back to the legacy JSON blob
+	        for conversations that have no turn rows yet.
+	"""
+	turns = frappe.get_all(
+		"Gemini Conversation Turn",
+		filters={"parent": conversation_id, "parenttype": "Gemini Conversation", "parentfield": "turns"},
+		fields=["role", "text"],
+		order_by="idx asc",
+	)
+	if turns:
+		return turns
+
+	legacy_blob = frappe.db.get_value("Gemini Conversation", conversation_id, "conversation")
+	return orjson.loads(legacy_blob) if legacy_blob else []
 
 
 @log_activity
@@ -749,6 +1459,8 @@ def save_conversation(conversation_id, title, conversation, user=None):
 def record_feedback(search_query, doctype_name, document_name, is_helpful):
 	"""Records user feedback on search results to improve future searches.
 
+	Nothing is committed here; the request that records the feedback commits once when it ends.
+
 	Args:
 	    search_query (str): The query that was searched.
 	    doctype_name (str): The name of the doctype that was searched.
@@ -764,8 +1476,7 @@ def record_feedback(search_query, doctype_name, document_name, is_helpful):
 		feedback_doc.doctype_name = doctype_name
 		feedback_doc.document_name = document_name
 		feedback_doc.is_helpful = int(is_helpful)
-		feedback_doc.save(ignore_permissions=True)
-		frappe.db.commit()
+		feedback_doc.insert(ignore_permissions=True)
 		return {"status": "success"}
 	except Exception as e:
 		frappe.log_error(f"Error recording feedback: {e!s}", "Gemini Integration")
@@ -773,14 +1484,56 @@ def record_feedback(search_query, doctype_name, document_name, is_helpful):
 
 
 # --- PROJECT-SPECIFIC FUNCTIONS ---
+
+# Response schema for generate_tasks; Gemini's structured output guarantees the shape.
+PROJECT_TASKS_SCHEMA = {
+	"type": "ARRAY",
+	"items": {
+		"type": "OBJECT",
+		"properties": {
+			"subject": {"type": "STRING"},
+			"description": {"type": "STRING"},
+		},
+		"required": ["subject", "description"],
+	},
+}
+
+# Response schema for analyze_risks.
+PROJECT_RISKS_SCHEMA = {
+	"type": "ARRAY",
+	"items": {
+		"type": "OBJECT",
+		"properties": {
+			"risk_name": {"type": "STRING", "description": "A short title for the risk."},
+			"risk_description": {"type": "STRING"},
+		},
+		"required": ["risk_name", "risk_description"],
+	},
+}
+
+
+def _get_project_details_json(project_id):
+	"""Returns a project as compact JSON for a prompt.
+
+	Empty values and standard fields such as `owner` or `modified` are left out, and
+	nothing is indented, since every byte of the dump is billed as prompt tokens.
+	"""
+	project = frappe.get_doc("Project", project_id)
+	return orjson.dumps(project.as_dict(no_nulls=True, no_default_fields=True), default=str).decode()
+
+
 @log_activity
 @handle_errors
-def generate_tasks(project_id, template):
+def generate_tasks(project_id, template, refresh=False):
 	"""Generates a list of tasks for a project using Gemini.
 
+	The response is reused until the project changes, unless `refresh` is set.
+
 	Args:
 	    project_id (str): The ID of the project.
 	    template (str): The template to use for task generation.
+	    refresh (bool, optional): Whether to ask Gemini again instead of reusing the
+	        previous response. Defaults to False.
 
 	Returns:
 	    dict: A dictionary containing the generated tasks or an error message.
@@ -788,31 +1541,37 @@ def generate_tasks(project_id, template):
 	if not frappe.db.exists("Project", project_id):
 		return {"error": "Project not found."}
 
-	project = frappe.get_doc("Project", project_id)
-	project_details = project.as_dict()
+	return _generate_tasks_for_details(_get_project_details_json(project_id), template, refresh)
+
 
+def _generate_tasks_for_details(project_details, template, refresh=False):
+	"""Asks Gemini for tasks for a project already serialized by `_get_project_details_json`."""
 	prompt = f"""
     Based on the following project details and the selected template '{template}', generate a list of tasks.
-    Project Details: {json.dumps(project_details, indent=2, default=str)}
-
-    Please return ONLY a valid JSON list of objects. Each object should have two keys: "subject" and "description".
-    Example: [{{"subject": "Initial client meeting", "description": "Discuss project scope and deliverables."}}, ...]    """
+    Project Details: {project_details}
+    """
 
-	response_text = generate_text(prompt)
+	# The prompt embeds every project field, so any change to the project misses the cache.
 	try:
-		tasks = json.loads(response_text)
-		return tasks
-	except json.JSONDecodeError:
+		tasks = generate_json(prompt, PROJECT_TASKS_SCHEMA, cache=not cint(refresh))
+	except orjson.JSONDecodeError:
+		tasks = None
+	if tasks is None:
 		return {"error": "Failed to parse a valid JSON response from the AI. Please try again."}
+	return tasks
 
 
 @log_activity
 @handle_errors
-def analyze_risks(project_id):
+def analyze_risks(project_id, refresh=False):
 	"""Analyzes a project for potential risks using Gemini.
 
+	The response is reused until the project changes, unless `refresh` is set.
+
 	Args:
 	    project_id (str): The ID of the project to analyze.
+	    refresh (bool, optional): Whether to ask Gemini again instead of reusing the
+	        previous response. Defaults to False.
 
 	Returns:
 	    dict: A dictionary containing the identified risks or an error message.
@@ -820,53 +1579,128 @@ def analyze_risks(project_id):
 	if not frappe.db.exists("Project", project_id):
 		return {"error": "Project not found."}
 
-	project = frappe.get_doc("Project", project_id)
-	project_details = project.as_dict()
+	return _analyze_risks_for_details(_get_project_details_json(project_id), refresh)
 
+
+def _analyze_risks_for_details(project_details, refresh=False):
+	"""Asks Gemini for the risks of a project already serialized by `_get_project_details_json`."""
 	prompt = f"""
     Analyze the following project for potential risks (e.g., timeline, budget, scope creep, resource constraints).
-    Project Details: {json.dumps(project_details, indent=2, default=str)}
-
-    Please return ONLY a valid JSON list of objects. Each object should have two keys: "risk_name" (a short title) and "risk_description".
-    Example: [{{"risk_name": "Scope Creep", "risk_description": "The project description is vague, which could lead to additional client requests not in the original scope."}}, ...]    """
+    Project Details: {project_details}
+    """
 
-	response_text = generate_text(prompt)
+	# The prompt embeds every project field, so any change to the project misses the cache.
 	try:
-		risks = json.loads(response_text)
-		return risks
-	except json.JSONDecodeError:
+		risks = generate_json(prompt, PROJECT_RISKS_SCHEMA, cache=not cint(refresh))
+	except orjson.JSONDecodeError:
+		risks = None
+	if risks is None:
 		return {"error": "Failed to parse a JSON response from the AI. Please try again."}
+	return risks
+
+
+@log_activity
+@handle_errors
+def generate_project_insights(project_id, template, refresh=False):
+	"""Generates tasks and analyzes risks for a project in one call.
+
+	The project is loaded and serialized once, and both Gemini requests run at the
+	same time, so the wait is that of the slower request rather than both.
+
+	Args:
+	    project_id (str): The ID of the project.
+	    template (str): The template to use for task generation.
+	    refresh (bool, optional): Whether to ask Gemini again instead of reusing the
+	        previous responses. Defaults to False.
+
+	Returns:
+	    dict: The `generate_tasks` result under "tasks" and the `analyze_risks` result
+	        under "risks", or an error message.
+	"""
+	if not frappe.db.exists("Project", project_id):
+		return {"error": "Project not found."}
+
+	project_details = _get_project_details_json(project_id)
+
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		risks_future = submit_with_site_context(
+			executor, _analyze_risks_for_details, project_details, refresh
+		)
+
+		tasks = _generate_tasks_for_details(project_details, template, refresh)
+
+		risks = risks_future.result()
+
+	return {"tasks": tasks, "risks": risks}
+
+
+# A whitespace-delimited token, as produced by str.split().
+_TOKEN_RE = re.compile(r"\S+")
 
 
 def _get_text_chunks(text, chunk_size=1000, overlap=100):
 	"""Splits text into chunks of a specified size with overlap."""
 	if not text:
 		return []
-	# Simple whitespace tokenizer
-	tokens = text.split()
+	# Simple whitespace tokenizer. Only the start and end offset of each token are
+	# kept, in one NumPy array, and every chunk is sliced straight out of the
+	# original text instead of re-joining a token list per window.
+	spans = np.fromiter(
+		itertools.chain.from_iterable(match.span() for match in _TOKEN_RE.finditer(text)),
+		dtype=np.int64,
+	).reshape(-1, 2)
+	token_count = len(spans)
+
+	step = max(chunk_size - overlap, 1)
 	chunks = []
-	for i in range(0, len(tokens), chunk_size - overlap):
-		chunks.append(" ".join(tokens[i : i + chunk_size]))
+	for i in range(0, token_count, step):
+		end = min(i + chunk_size, token_count)
+		chunks.append(text[spans[i, 0] : spans[end - 1, 1]])
+		if end == token_count:
+			# The remaining tokens are already covered by this chunk's overlap.
+			break
 	return chunks
 
 
+# Embedding requests a batch job keeps in flight while it loads and inserts documents.
+EMBEDDING_PIPELINE_WORKERS = 4
+
+# Documents queued between backfill progress events sent to the browser.
+EMBEDDING_BACKFILL_PROGRESS_INTERVAL = 500
+
+# Cleared by GeminiSettings.on_update whenever the settings are saved.
+EMBEDDING_DOCTYPES_CACHE_KEY = "gemini_embedding_doctypes"
+
+# Documents per background job when backfilling, unless set in Gemini Settings.
+DEFAULT_EMBEDDING_BACKFILL_CHUNK_SIZE = 100
+
+# Column order used when bulk-inserting Gemini Embedding rows.
+EMBEDDING_INSERT_FIELDS = (
+	"name",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"ref_doctype",
+	"ref_docname",
+	"chunk_number",
+	"chunk_hash",
+	"content",
+	"embedding",
+	"vector_blob",
+	"vector_dtype",
+	"status",
+)
+
+
 def update_embedding(doc, method):
 	"""
 	Creates or updates the embedding for a document. This will be called by the on_update hook.
 	"""
 	# This function will now just enqueue the background job
 	try:
-		# When a document is updated, we need to clear out all the old chunks
-		# and regenerate them. The background job will handle the creation.
-		# We'll just delete the existing ones here.
-		existing_embeddings = frappe.get_all(
-			"Gemini Embedding",
-			filters={"ref_doctype": doc.doctype, "ref_docname": doc.name},
-			pluck="name",
-		)
-		for embedding_name in existing_embeddings:
-			frappe.delete_doc("Gemini Embedding", embedding_name, ignore_permissions=True)
-
+		# The background job replaces the old chunks once it has looked up which of
+		# their vectors can be reused, so they are not deleted here.
 		frappe.enqueue(
 			"gemini_integration.gemini.generate_embedding_in_background",
 			doctype=doc.doctype,
@@ -891,6 +1725,108 @@ def delete_embeddings_for_doc(doc, method):
 	)
 
 
+def _get_embedding_content(source_doc):
+	"""Builds the text that is chunked and embedded for a document.
+
+	The raw field values are read without as_dict() copies; the labels add little
+	to the embedding, so field names are used as-is instead of being unscrubbed.
+
+	Args:
+		source_doc (frappe.model.document.Document): The document to embed.
+
+	Returns:
+		str: The document's scalar field values, one `field: value` pair per line.
+	"""
+	return f"Document: {source_doc.name}\n" + "\n".join(
+		f"{field}: {value}"
+		for field, value in source_doc.get_valid_dict(convert_dates_to_str=True).items()
+		if value and isinstance(value, str | int | float)
+	)
+
+
+def _get_embedding_dtype():
+	"""Returns how new embedding vectors are stored, as set in Gemini Settings.
+
+	Returns:
+		str: "JSON", or one of the packed dtypes in EMBEDDING_DTYPES.
+	"""
+	embedding_dtype = frappe.db.get_single_value("Gemini Settings", "embedding_dtype") or "float32"
+	return embedding_dtype if embedding_dtype in EMBEDDING_DTYPES else "JSON"
+
+
+def _get_embedding_rows(doctype, docname, chunks, embedding_vectors, embedding_dtype):
+	"""Builds the Gemini Embedding rows for a document's chunks.
+
+	Args:
+		doctype (str): The DocType of the document.
+		docname (str): The name/ID of the document.
+		chunks (list): The text chunks of the document.
+		embedding_vectors (list): The embedding for each chunk, in the same order.
+		embedding_dtype (str): "JSON" to store the vectors as JSON text, or a packed
+			dtype from EMBEDDING_DTYPES.
+
+	Returns:
+		list: Tuples ordered as EMBEDDING_INSERT_FIELDS, ready for bulk_insert.
+	"""
+	now = frappe.utils.now()
+	user = frappe.session.user
+	packed = embedding_dtype in EMBEDDING_DTYPES
+	return [
+		(
+			frappe.generate_hash(length=10),
+			now,
+			now,
+			user,
+			user,
+			doctype,
+			docname,
+			i,
+			_get_chunk_hash(chunk),
+			chunk,
+			None if packed else orjson.dumps(embedding_vector).decode(),
+			pack_embedding(embedding_vector, embedding_dtype) if packed else None,
+			embedding_dtype if packed else None,
+			"Completed",
+		)
+		for i, (chunk, embedding_vector) in enumerate(zip(chunks, embedding_vectors, strict=True))
+	]
+
+
+def _get_chunk_hash(chunk):
+	"""Returns the SHA-256 hex digest identifying a chunk's text."""
+	return hashlib.sha256(chunk.encode()).hexdigest()
+
+
+def _resolve_chunk_vectors(chunks):
+	"""Looks up stored vectors for chunks whose exact text has been embedded before.
+
+	Args:
+		chunks (list): The text chunks to embed.
+
+	Returns:
+		tuple: The hash of each chunk, a dict of the vectors already stored by hash,
+			and a dict of the unique texts that still need embedding, by hash.
+	"""
+	chunk_hashes = [_get_chunk_hash(chunk) for chunk in chunks]
+	stored_rows = frappe.get_all(
+		"Gemini Embedding",
+		filters={"chunk_hash": ("in", list(set(chunk_hashes)))},
+		fields=["chunk_hash", "embedding", "vector_blob", "vector_dtype"],
+	)
+	vectors_by_hash = {}
+	for row in stored_rows:
+		if row.chunk_hash not in vectors_by_hash:
+			vector = unpack_embedding(row)
+			if vector is not None:
+				vectors_by_hash[row.chunk_hash] = vector.tolist()
+
+	texts_to_embed = {}
+	for chunk_hash, chunk in zip(chunk_hashes, chunks, strict=True):
+		if chunk_hash not in vectors_by_hash:
+			texts_to_embed.setdefault(chunk_hash, chunk)
+	return chunk_hashes, vectors_by_hash, texts_to_embed
+
+
 def generate_embedding_in_background(doctype, docname):
 	"""
 	Generates and saves an embedding for a specific document in the background.
@@ -903,32 +1839,38 @@ def generate_embedding_in_background(doctype, docname):
 	try:
 		# 1. Get the content of the source document
 		source_doc = frappe.get_doc(doctype, docname)
-		content_to_embed = f"Document: {docname}\n"
-		for field, value in source_doc.as_dict().items():
-			if value and not isinstance(value, list | dict | type(None)):
-				content_to_embed += f"{frappe.unscrub(field)}: {value}\n"
+		content_to_embed = _get_embedding_content(source_doc)
 
 		# 2. Split the content into chunks
 		chunks = _get_text_chunks(content_to_embed)
+		if not chunks:
+			frappe.db.delete("Gemini Embedding", {"ref_doctype": doctype, "ref_docname": docname})
+			return
 
-		# 3. Generate an embedding for each chunk and save it as a new document
-		for i, chunk in enumerate(chunks):
-			embedding_vector = generate_embedding(chunk)
-			if embedding_vector:
-				embedding_doc = frappe.new_doc("Gemini Embedding")
-				embedding_doc.ref_doctype = doctype
-				embedding_doc.ref_docname = docname
-				embedding_doc.chunk_number = i
-				embedding_doc.content = chunk
-				embedding_doc.embedding = json.dumps(embedding_vector)
-				embedding_doc.status = "Completed"
-				embedding_doc.insert(ignore_permissions=True)
-			else:
-				# Log an error for this specific chunk
-				frappe.log_error(
-					message=f"Failed to generate embedding for chunk {i} of {doctype} {docname}",
-					title="Gemini Chunk Embedding Error",
-				)
+		# 3. Reuse the vectors of chunks embedded before and embed the rest in batched requests
+		chunk_hashes, vectors_by_hash, texts_to_embed = _resolve_chunk_vectors(chunks)
+		new_vectors = generate_embeddings(list(texts_to_embed.values()))
+		if new_vectors is None:
+			frappe.log_error(
+				message=f"Failed to generate embeddings for {doctype} {docname}",
+				title="Gemini Chunk Embedding Error",
+			)
+			return
+		vectors_by_hash.update(zip(texts_to_embed, new_vectors, strict=True))
+
+		# 4. Replace the old chunks, inserting the new rows in one statement
+		frappe.db.delete("Gemini Embedding", {"ref_doctype": doctype, "ref_docname": docname})
+		frappe.db.bulk_insert(
+			"Gemini Embedding",
+			fields=EMBEDDING_INSERT_FIELDS,
+			values=_get_embedding_rows(
+				doctype,
+				docname,
+				chunks,
+				[vectors_by_hash[chunk_hash] for chunk_hash in chunk_hashes],
+				_get_embedding_dtype(),
+			),
+		)
 
 	except Exception as e:
 		frappe.log_error(
@@ -937,18 +1879,128 @@ def generate_embedding_in_background(doctype, docname):
 		)
 
 
+def generate_embeddings_for_batch(doctype, docnames):
+	"""
+	Regenerates the embeddings for a batch of documents of one DocType in the background.
+
+	The work is pipelined: while groups of chunks are being embedded on worker threads,
+	this thread keeps loading and chunking the next documents and inserts each group's
+	rows as soon as its embeddings arrive. At most EMBEDDING_PIPELINE_WORKERS groups are
+	in flight at once, so a slow API applies backpressure to loading. Chunks whose text
+	has been embedded before reuse the stored vector instead of being sent to the API.
+
+	Args:
+		doctype (str): The DocType of the documents.
+		docnames (list): The names/IDs of the documents.
+	"""
+	try:
+		client = get_gemini_client()
+		if not client:
+			return
+
+		embedding_dtype = _get_embedding_dtype()
+		in_flight = deque()
+		failed_groups = []
+
+		def submit_group(executor, group):
+			# Look up reusable vectors before the group's old rows are replaced.
+			chunk_hashes, vectors_by_hash, texts_to_embed = _resolve_chunk_vectors(
+				[chunk for _, chunks in group for chunk in chunks]
+			)
+			future = executor.submit(embed_texts, client, list(texts_to_embed.values()))
+			in_flight.append((group, chunk_hashes, vectors_by_hash, list(texts_to_embed), future))
+
+		def insert_group(group, chunk_hashes, vectors_by_hash, embedded_hashes, future):
+			# Database writes stay on this thread, which owns the connection.
+			try:
+				vectors_by_hash.update(zip(embedded_hashes, future.result(), strict=True))
+			except Exception as e:
+				# Collected and logged once for the whole batch, so an API outage does not
+				# write an Error Log row per group.
+				failed_groups.append(([docname for docname, _ in group], str(e)))
+				return
+
+			embedding_vectors = [vectors_by_hash[chunk_hash] for chunk_hash in chunk_hashes]
+			rows = []
+			offset = 0
+			for docname, chunks in group:
+				rows.extend(
+					_get_embedding_rows(
+						doctype,
+						docname,
+						chunks,
+						embedding_vectors[offset : offset + len(chunks)],
+						embedding_dtype,
+					)
+				)
+				offset += len(chunks)
+			frappe.db.delete(
+				"Gemini Embedding",
+				{"ref_doctype": doctype, "ref_docname": ("in", [docname for docname, _ in group])},
+			)
+			frappe.db.bulk_insert("Gemini Embedding", fields=EMBEDDING_INSERT_FIELDS, values=rows)
+
+		document_chunks = []
+		chunk_count = 0
+		empty_docnames = []
+		with ThreadPoolExecutor(max_workers=EMBEDDING_PIPELINE_WORKERS) as executor:
+			for docname in docnames:
+				# 1. Load and chunk the next document
+				try:
+					source_doc = frappe.get_doc(doctype, docname)
+					chunks = _get_text_chunks(_get_embedding_content(source_doc))
+				except frappe.DoesNotExistError:
+					# Deleted since the backfill was enqueued.
+					chunks = []
+				if not chunks:
+					empty_docnames.append(docname)
+					continue
+				document_chunks.append((docname, chunks))
+				chunk_count += len(chunks)
+
+				# 2. Hand a full group to the embedding workers
+				if chunk_count >= EMBEDDING_BATCH_SIZE:
+					submit_group(executor, document_chunks)
+					document_chunks = []
+					chunk_count = 0
+					# 3. Replace the oldest group's rows once the pipeline is full
+					if len(in_flight) >= EMBEDDING_PIPELINE_WORKERS:
+						insert_group(*in_flight.popleft())
+
+			if document_chunks:
+				submit_group(executor, document_chunks)
+			while in_flight:
+				insert_group(*in_flight.popleft())
+
+		# Documents with nothing left to embed lose their old chunks in a single statement.
+		if empty_docnames:
+			frappe.db.delete(
+				"Gemini Embedding", {"ref_doctype": doctype, "ref_docname": ("in", empty_docnames)}
+			)
+
+		if failed_groups:
+			frappe.log_error(
+				message=f"Failed to generate embeddings for {sum(len(names) for names, _ in failed_groups)} "
+				f"{doctype} documents:\n"
+				+ "\n".join(f"{', '.join(names)}: {error}" for names, error in failed_groups),
+				title="Gemini Chunk Embedding Error",
+			)
+
+	except Exception as e:
+		frappe.log_error(
+			message=f"Failed to generate embeddings for a batch of {doctype} documents: {e!s}\n{frappe.get_traceback()}",
+			title="Gemini Embedding Generation Error",
+		)
+
+
 def delete_embedding_in_background(doctype, docname):
 	"""
 	Deletes the embedding for a document in the background.
 	"""
 	try:
-		embedding_docs = frappe.get_all(
-			"Gemini Embedding",
-			filters={"ref_doctype": doctype, "ref_docname": docname},
-			pluck="name",
-		)
-		for embedding_name in embedding_docs:
-			frappe.delete_doc("Gemini Embedding", embedding_name, ignore_permissions=True)
+		# Gemini Embedding has no delete hooks, so all chunks go in a single statement.
+		frappe.db.delete("Gemini Embedding", {"ref_doctype": doctype, "ref_docname": docname})
+		frappe.db.commit()
 	except Exception as e:
 		frappe.log_error(
 			message=f"Failed to delete embedding for {doctype} {docname}: {e!s}\n{frappe.get_traceback()}",
@@ -956,48 +2008,249 @@ def delete_embedding_in_background(doctype, docname):
 		)
 
 
+# Opportunities above this amount get a generated Deal Brief when they are created.
+DEAL_BRIEF_MIN_AMOUNT = 5000
+
+# The Opportunity fields given to the model, rather than every field and child table.
+_OPP_FIELDS = (
+	"name",
+	"party_name",
+	"opportunity_from",
+	"opportunity_type",
+	"status",
+	"sales_stage",
+	"opportunity_amount",
+	"currency",
+	"transaction_date",
+	"expected_closing",
+	"contact_email",
+)
+
+DEAL_BRIEF_PROMPT_HEADER = 'Create a "Deal Brief" summarizing the following opportunity, customer history, and recent interactions.\n'
+
+# Short-lived, so a burst of Opportunities for one customer shares the customer and project lookups.
+CUSTOMER_DOSSIER_CACHE_TTL = 60
+
+# Recent mail about a customer changes slowly enough to share between briefs for a while.
+DEAL_BRIEF_GMAIL_CACHE_TTL = 15 * 60
+
+
+def get_customer_dossier(party_name):
+	"""Fetches a party's customer record, projects and opportunities.
+
+	Projects and opportunities are looked up by `party_name` whatever the party type, so
+	an Opportunity from a Lead still gets the Lead's other opportunities. The customer
+	record and projects are cached briefly; opportunities are always read fresh so the
+	Opportunity that triggered the brief is never missing.
+
+	Args:
+	    party_name (str): The `party_name` of the Opportunity.
+
+	Returns:
+	    dict: The `customer` record (or None), and lists of its `projects` and `opportunities`.
+	"""
+	cache_key = f"gemini_customer_dossier:{party_name}"
+	dossier = frappe.cache().get_value(cache_key)
+	if dossier is None:
+		dossier = {
+			"customer": frappe.db.get_value(
+				"Customer", party_name, ["name", "customer_name", "email_id", "mobile_no"], as_dict=True
+			),
+			"projects": frappe.get_all(
+				"Project",
+				filters={"customer": party_name},
+				fields=[
+					"name",
+					"project_name",
+					"status",
+					"priority",
+					"expected_start_date",
+					"expected_end_date",
+				],
+			),
+		}
+		frappe.cache().set_value(cache_key, dossier, expires_in_sec=CUSTOMER_DOSSIER_CACHE_TTL)
+
+	return {
+		**dossier,
+		"opportunities": frappe.get_all(
+			"Opportunity",
+			filters={"party_name": party_name},
+			fields=["name", "opportunity_from", "status", "opportunity_amount"],
+		),
+	}
+
+
+def _get_party_gmail_history(party_name):
+	"""Returns the recent Gmail messages about a customer for the current user.
+
+	Results are cached per user, since each user's mailbox is searched with their own
+	credentials. Error messages are not cached, so a failed search is retried next time.
+	"""
+	cache_key = f"gemini_deal_brief_gmail:{frappe.session.user}:{party_name}"
+	gmail_history = frappe.cache().get_value(cache_key)
+	if gmail_history is not None:
+		return gmail_history
+
+	gmail_history = search_gmail(query=party_name)
+	if isinstance(gmail_history, str) and gmail_history.startswith(("Recent emails", "No recent emails")):
+		frappe.cache().set_value(cache_key, gmail_history, expires_in_sec=DEAL_BRIEF_GMAIL_CACHE_TTL)
+	return gmail_history
+
+
 def create_deal_brief_for_opportunity(doc, method):
 	"""
 	When a new high-value Opportunity is created, trigger a hook that creates a "Deal Brief".
+	Later saves of the same Opportunity do not generate another brief.
+
+	The brief is built in a background job, so the save is not held up by the lookups
+	and the Gemini call.
 	"""
-	if doc.opportunity_amount > 5000:
-		customer_details = fetch_erpnext_data(
-			doctype="Customer",
-			filters={"name": doc.party_name},
-			fields=["name", "customer_name", "email", "phone", "mobile_no"],
+	# `in_insert` stays set through after_insert and the on_update that follows an insert.
+	is_new_opportunity = doc.is_new() or doc.flags.in_insert
+	if is_new_opportunity and flt(doc.opportunity_amount) > DEAL_BRIEF_MIN_AMOUNT:
+		frappe.enqueue(
+			"gemini_integration.gemini._build_deal_brief",
+			queue="long",
+			enqueue_after_commit=True,
+			opportunity=doc.name,
 		)
 
-		customer_projects = fetch_erpnext_data(
-			doctype="Project",
-			filters={"customer": doc.party_name},
-			fields=["name", "project_name", "status", "priority", "start_date", "end_date"],
-		)
 
-		customer_opportunities = fetch_erpnext_data(
-			doctype="Opportunity",
-			filters={"party_name": doc.party_name},
-			fields=["name", "opportunity_from", "status", "opportunity_amount"],
-		)
+def _build_deal_brief(opportunity):
+	"""
+	Builds the "Deal Brief" for an Opportunity and adds it as a comment.
 
-		gmail_history = search_gmail(query=doc.party_name)
+	Args:
+		opportunity (str): The name of the Opportunity.
+	"""
+	doc = frappe.get_doc("Opportunity", opportunity)
+
+	# The Gmail search is the slow, external call, so it runs on a worker thread while
+	# the ERPNext lookup runs here.
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		gmail_future = submit_with_site_context(executor, _get_party_gmail_history, doc.party_name)
+
+		dossier = get_customer_dossier(doc.party_name)
+
+		gmail_history = gmail_future.result()
+
+	# Each section is serialized once, compactly, straight into the prompt buffer.
+	prompt_buffer = StringIO()
+	prompt_buffer.write(DEAL_BRIEF_PROMPT_HEADER)
+	for label, data in (
+		("Opportunity", {field: doc.get(field) for field in _OPP_FIELDS}),
+		("Customer Details", dossier["customer"]),
+		("Customer Projects", dossier["projects"]),
+		("Customer Opportunities", dossier["opportunities"]),
+	):
+		prompt_buffer.write(f"{label}: ")
+		json.dump(data, prompt_buffer, default=str, separators=(",", ":"))
+		prompt_buffer.write("\n")
+	prompt_buffer.write(f"Recent Emails: {gmail_history}\n")
+	prompt = prompt_buffer.getvalue()
+
+	deal_brief = generate_text(prompt)
+
+	create_comment(
+		reference_doctype="Opportunity",
+		reference_name=doc.name,
+		comment=deal_brief,
+		confirmed=True,
+	)
 
-		prompt = f"""
-        Create a "Deal Brief" summarizing the following opportunity, customer history, and recent interactions.
-        Opportunity: {doc.as_dict()}
-        Customer Details: {customer_details}
-        Customer Projects: {customer_projects}
-        Customer Opportunities: {customer_opportunities}
-        Recent Emails: {gmail_history}
-        """
 
-		deal_brief = generate_text(prompt)
+def get_embedding_doctypes():
+	"""Returns the DocTypes configured for embedding in Gemini Settings.
+
+	The list is cached until Gemini Settings is next saved.
+
+	Returns:
+		list: The configured DocType names, in the order they are listed.
+	"""
+	doctypes = frappe.cache().get_value(EMBEDDING_DOCTYPES_CACHE_KEY)
+	if doctypes is None:
+		settings = frappe.get_single("Gemini Settings")
+		doctypes = [link.doctype_name for link in settings.get("embedding_doctypes", [])]
+		frappe.cache().set_value(EMBEDDING_DOCTYPES_CACHE_KEY, doctypes)
+	return doctypes
+
+
+def iter_docnames(doctype, page_size=1000):
+	"""Yields the names of all documents of a DocType, one page at a time.
+
+	Pages are read with keyset pagination on `name`, so only one page is held in
+	memory and later pages do not get slower the way OFFSET scans do.
+
+	Args:
+		doctype (str): The DocType to read.
+		page_size (int, optional): The number of names per page. Defaults to 1000.
+
+	Yields:
+		list: The next page of document names, in name order.
+	"""
+	table = frappe.qb.DocType(doctype)
+	last_name = ""
+	while True:
+		names = (
+			frappe.qb.from_(table)
+			.select(table.name)
+			.where(table.name > last_name)
+			.orderby(table.name)
+			.limit(page_size)
+		).run(pluck=True)
+		if not names:
+			return
+		yield names
+		last_name = names[-1]
+
+
+def _enqueue_embedding_batches(doctype, chunk_size):
+	"""Enqueues a generate_embeddings_for_batch job for every page of a DocType's documents.
+
+	Args:
+		doctype (str): The DocType to embed.
+		chunk_size (int): The number of documents per job.
+
+	Progress is published to the user as an `embedding_backfill_progress` event about
+	every EMBEDDING_BACKFILL_PROGRESS_INTERVAL documents rather than per batch.
+
+	Returns:
+		int: The number of documents enqueued.
+	"""
+	total_count = frappe.db.count(doctype)
+	enqueued_count = 0
+	reported_count = 0
+	for batch in iter_docnames(doctype, page_size=chunk_size):
+		enqueued_count += len(batch)
+		if enqueued_count - reported_count >= EMBEDDING_BACKFILL_PROGRESS_INTERVAL:
+			_publish_backfill_progress(doctype, enqueued_count, total_count)
+			reported_count = enqueued_count
+		try:
+			# Each job deletes and regenerates the embeddings for its whole batch.
+			frappe.enqueue(
+				"gemini_integration.gemini.generate_embeddings_for_batch",
+				queue="long",
+				doctype=doctype,
+				docnames=batch,
+			)
+		except Exception as e:
+			frappe.log_error(
+				message=f"Failed to enqueue an embedding batch for doctype {doctype}: {e!s}\n{frappe.get_traceback()}",
+				title="Gemini Embedding Backfill Error",
+			)
+	if enqueued_count != reported_count:
+		_publish_backfill_progress(doctype, enqueued_count, total_count)
+	return enqueued_count
 
-		create_comment(
-			reference_doctype="Opportunity",
-			reference_name=doc.name,
-			comment=deal_brief,
-			confirmed=True,
-		)
+
+def _publish_backfill_progress(doctype, done, total):
+	"""Tells the user how many documents of a DocType have been queued for embedding."""
+	frappe.publish_realtime(
+		"embedding_backfill_progress",
+		{"doctype": doctype, "done": done, "total": max(total, done)},
+		user=frappe.session.user,
+	)
 
 
 def backfill_embeddings():
@@ -1006,47 +2259,29 @@ def backfill_embeddings():
 	This is triggered manually and bypasses the `save` method to avoid validation errors.
 	"""
 	try:
-		settings = frappe.get_single("Gemini Settings")
-		doctypes_to_embed = [link.doctype_name for link in settings.get("embedding_doctypes", [])]
+		doctypes_to_embed = get_embedding_doctypes()
+		chunk_size = (
+			cint(frappe.db.get_single_value("Gemini Settings", "embedding_backfill_chunk_size"))
+			or DEFAULT_EMBEDDING_BACKFILL_CHUNK_SIZE
+		)
 
 		if not doctypes_to_embed:
 			frappe.log("No DocTypes configured for embedding in Gemini Settings.")
 			return
 
+		# Gemini Settings only accepts existing DocTypes, so only one deleted since then
+		# can be missing here; that shows up as a missing table on the first page.
 		for doctype in doctypes_to_embed:
-			if not frappe.db.exists("DocType", doctype):
+			try:
+				_enqueue_embedding_batches(doctype, chunk_size)
+			except Exception as e:
+				if not frappe.db.is_table_missing(e):
+					raise
 				frappe.log_error(
 					f"DocType '{doctype}' configured for embedding does not exist.", "Gemini Integration"
 				)
 				continue
 
-			documents = frappe.get_all(doctype, fields=["name"])
-			for doc_info in documents:
-				docname = doc_info.name
-				try:
-					# 1. Delete existing embeddings for the document
-					existing_embeddings = frappe.get_all(
-						"Gemini Embedding",
-						filters={"ref_doctype": doctype, "ref_docname": docname},
-						pluck="name",
-					)
-					for embedding_name in existing_embeddings:
-						frappe.delete_doc("Gemini Embedding", embedding_name, ignore_permissions=True)
-
-					# 2. Enqueue the generation of new embeddings
-					frappe.enqueue(
-						"gemini_integration.gemini.generate_embedding_in_background",
-						doctype=doctype,
-						docname=docname,
-					)
-					frappe.log(f"Successfully enqueued embedding generation for {doctype} - {docname}")
-
-				except Exception as e:
-					frappe.log_error(
-						message=f"Failed to process document {docname} of doctype {doctype}: {e!s}\n{frappe.get_traceback()}",
-						title="Gemini Embedding Backfill Error",
-					)
-
 		frappe.publish_realtime(
 			"embedding_backfill_complete",
 			{"message": "Successfully generated embeddings for all configured DocTypes."},
@@ -1076,6 +2311,7 @@ def bulk_embed_files_in_background():
 		# Get all non-private files
 		files = frappe.get_all("File", filters={"is_private": 0}, fields=["name", "file_url"])
 
+		file_store_ids = []
 		for file_info in files:
 			file_url = file_info.file_url
 			try:
@@ -1096,12 +2332,7 @@ def bulk_embed_files_in_background():
 				embedding_doc.content = content_str
 				embedding_doc.status = "Pending"
 				embedding_doc.save(ignore_permissions=True)
-
-				# Enqueue the generation of the embedding
-				frappe.enqueue(
-					"gemini_integration.gemini.generate_file_embedding_in_background",
-					file_store_id=embedding_doc.name,
-				)
+				file_store_ids.append(embedding_doc.name)
 
 			except Exception as e:
 				frappe.log_error(
@@ -1109,6 +2340,14 @@ def bulk_embed_files_in_background():
 					title="Gemini File Embedding Error",
 				)
 
+		# Enqueue the generation of the embeddings, one batched API request per job
+		for batch in create_batch(file_store_ids, EMBEDDING_BATCH_SIZE):
+			frappe.enqueue(
+				"gemini_integration.gemini.generate_file_embeddings_for_batch",
+				queue="long",
+				file_store_ids=list(batch),
+			)
+
 	except Exception as e:
 		frappe.log_error(
 			message=f"An error occurred during the bulk file embedding process: {e!s}\n{frappe.get_traceback()}",
@@ -1132,7 +2371,7 @@ def generate_file_embedding_in_background(file_store_id):
 
 		if embedding_vector:
 			# Update the Gemini File Store document
-			file_store_doc.embedding = json.dumps(embedding_vector)
+			file_store_doc.embedding = orjson.dumps(embedding_vector).decode()
 			file_store_doc.status = "Completed"
 			file_store_doc.save(ignore_permissions=True)
 		else:
@@ -1153,6 +2392,49 @@ def generate_file_embedding_in_background(file_store_id):
 		)
 
 
+def generate_file_embeddings_for_batch(file_store_ids):
+	"""
+	Generates and saves the embeddings for a batch of files in the background.
+	All files in the batch are embedded with a single API request.
+
+	Args:
+		file_store_ids (list): The IDs of the Gemini File Store documents.
+	"""
+	try:
+		file_stores = frappe.get_all(
+			"Gemini File Store",
+			filters={"name": ("in", file_store_ids)},
+			fields=["name", "content"],
+		)
+		embedding_vectors = generate_embeddings([file_store.content or "" for file_store in file_stores])
+
+		if not embedding_vectors:
+			frappe.db.set_value(
+				"Gemini File Store",
+				{"name": ("in", file_store_ids)},
+				{"status": "Error", "error_message": "Failed to generate embedding."},
+			)
+			return
+
+		for file_store, embedding_vector in zip(file_stores, embedding_vectors, strict=True):
+			frappe.db.set_value(
+				"Gemini File Store",
+				file_store.name,
+				{"embedding": orjson.dumps(embedding_vector).decode(), "status": "Completed"},
+			)
+
+	except Exception as e:
+		frappe.db.set_value(
+			"Gemini File Store",
+			{"name": ("in", file_store_ids)},
+			{"status": "Error", "error_message": f"An error occurred: {e!s}"},
+		)
+		frappe.log_error(
+			message=f"Failed to generate embeddings for {len(file_store_ids)} files: {e!s}\n{frappe.get_traceback()}",
+			title="Gemini File Embedding Generation Error",
+		)
+
+
 def embed_new_file(doc, method):
 	"""
 	Creates an embedding for a new file. This will be called by the on_update hook for the File doctype.
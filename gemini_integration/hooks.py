@@ -171,6 +171,11 @@ doc_events["File"] = {
 	"on_trash": "gemini_integration.gemini.delete_file_embedding",
 }
 
+doc_events["Social Login Key"] = {
+	"on_update": "gemini_integration.utils.bump_google_settings_version",
+	"on_trash": "gemini_integration.utils.bump_google_settings_version",
+}
+
 # Scheduled Tasks
 # ---------------
 
@@ -516,7 +516,7 @@ function createGeminiChatUI(parentElement, options = {}) {
 				if (r.message) {
 					currentConversation = r.message.name;
 					chat_history.empty();
-					conversation = JSON.parse(r.message.conversation || "[]");
+					conversation = r.message.turns || [];
 					conversation.forEach((msg) => add_to_history(msg.role, msg.text));
 					load_conversations();
 				}
@@ -4,6 +4,7 @@ import functools
 import json
 import logging
 import re
+import tempfile
 import traceback
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
@@ -11,21 +12,59 @@ from io import BytesIO
 
 import frappe
 import numpy as np
+import orjson
 from frappe.utils import get_url_to_form
+from frappe.utils.response import json_handler
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
 from thefuzz import fuzz, process
 
 from gemini_integration.mcp import mcp
 from gemini_integration.utils import generate_embedding, get_user_credentials, handle_errors, log_activity
 
+# Drive downloads are streamed in chunks and only spill to disk above the spool size.
+DRIVE_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DRIVE_DOWNLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+
 
 def cosine_similarity(v1, v2):
 	"""Calculates the cosine similarity between two vectors."""
 	return np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
 
 
+# Packed embedding formats, stored base64-encoded in Gemini Embedding.vector_blob.
+EMBEDDING_DTYPES = {"float32": np.float32, "float16": np.float16}
+
+
+def pack_embedding(vector, dtype):
+	"""Packs an embedding vector into base64-encoded raw bytes of the given dtype."""
+	return base64.b64encode(np.asarray(vector, dtype=EMBEDDING_DTYPES[dtype]).tobytes()).decode()
+
+
+def unpack_embedding(emb_info):
+	"""Returns the vector of a Gemini Embedding row as a float32 array, or None if it has none.
+
+	Rows written before vectors were packed only have the JSON `embedding` column.
+	"""
+	if emb_info.get("vector_blob") and emb_info.get("vector_dtype") in EMBEDDING_DTYPES:
+		return np.frombuffer(
+			base64.b64decode(emb_info["vector_blob"]), dtype=EMBEDDING_DTYPES[emb_info["vector_dtype"]]
+		).astype(np.float32)
+	if not emb_info.get("embedding") or not isinstance(emb_info["embedding"], str):
+		return None
+	try:
+		return np.array(orjson.loads(emb_info["embedding"]), dtype=np.float32)
+	except orjson.JSONDecodeError:
+		return None
+
+
+def _doc_to_json_dict(doc):
+	"""Returns a document as a JSON-safe dict, serialized the same way as `frappe.as_json`."""
+	# Dates are passed to Frappe's handler so they keep its formatting rather than ISO 8601.
+	return orjson.loads(orjson.dumps(doc, default=json_handler, option=orjson.OPT_PASSTHROUGH_DATETIME))
+
+
 def find_similar_documents(query_embedding, doctype=None, limit=5):
 	"""Finds similar documents using vector similarity search on document chunks."""
 	filters = {}
@@ -34,7 +73,7 @@ def find_similar_documents(query_embedding, doctype=None, limit=5):
 
 	all_embeddings = frappe.get_all(
 		"Gemini Embedding",
-		fields=["ref_doctype", "ref_docname", "embedding", "content"],
+		fields=["ref_doctype", "ref_docname", "embedding", "vector_blob", "vector_dtype", "content"],
 		filters=filters,
 	)
 
@@ -45,11 +84,8 @@ def find_similar_documents(query_embedding, doctype=None, limit=5):
 	all_matching_chunks = []
 	for emb_info in all_embeddings:
 		# Skip if embedding is missing or invalid
-		if not emb_info.get("embedding") or not isinstance(emb_info["embedding"], str):
-			continue
-		try:
-			stored_embedding = np.array(json.loads(emb_info["embedding"]))
-		except (json.JSONDecodeError, TypeError):
+		stored_embedding = unpack_embedding(emb_info)
+		if stored_embedding is None:
 			continue
 
 		score = cosine_similarity(query_embedding, stored_embedding)
@@ -193,7 +229,7 @@ def fetch_erpnext_data(doctype: str, filters: dict, fields: list[str]) -> str:
 
 	# --- Safeguard 1: DocType Allowlist ---
 	try:
-		settings = frappe.get_single("Gemini Settings")
+		settings = frappe.get_cached_doc("Gemini Settings")
 		allowed_doctypes = [d.doctype_to_query for d in settings.get("queryable_doctypes", [])]
 		if doctype not in allowed_doctypes:
 			return json.dumps(
@@ -431,6 +467,10 @@ def get_doc_context(doctype: str, docname: str) -> str:
 get_doc_context.service = "erpnext"
 
 
+# A query that looks like a document ID, such as 'PRJ-0001' or 'SINV-2024-00012'.
+_DOCUMENT_ID_RE = re.compile(r"^([A-Z]{2,}[-.]?)+(\d{4,})([-.]?\d+)*$", re.IGNORECASE)
+
+
 @mcp.tool()
 @log_activity
 @handle_errors
@@ -456,7 +496,7 @@ def search_erpnext_documents(query: str, doctype: str | None = None, limit: int
 
 		# --- Priority #1: Exact ID Match ---
 		# Use a flexible regex to detect if the query is a likely document ID, then verify its existence.
-		if re.match(r"^([A-Z]{2,}[-.]?)+(\d{4,})([-.]?\d+)*$", query.strip(), re.IGNORECASE):
+		if _DOCUMENT_ID_RE.match(query.strip()):
 			# If a specific doctype is provided, check only that one.
 			# Otherwise, check all non-single DocTypes.
 			doctypes_to_check = (
@@ -466,7 +506,7 @@ def search_erpnext_documents(query: str, doctype: str | None = None, limit: int
 				if frappe.db.exists(dt, query):
 					# If a match is found, fetch the full document and return it as a confident match.
 					doc = frappe.get_doc(dt, query)
-					doc_dict = json.loads(frappe.as_json(doc))
+					doc_dict = _doc_to_json_dict(doc)
 					meta = frappe.get_meta(dt)
 					title_field = meta.get_title_field()
 					label = (title_field and doc.get(title_field)) or doc.name
@@ -497,7 +537,7 @@ def search_erpnext_documents(query: str, doctype: str | None = None, limit: int
 				):
 					top_doc_info = relevant_docs[0]
 					doc = frappe.get_doc(top_doc_info["doctype"], top_doc_info["name"])
-					doc_dict = json.loads(frappe.as_json(doc))
+					doc_dict = _doc_to_json_dict(doc)
 					meta = frappe.get_meta(top_doc_info["doctype"])
 					title_field = meta.get_title_field()
 					label = (title_field and doc.get(title_field)) or doc.name
@@ -604,7 +644,7 @@ def search_erpnext_documents(query: str, doctype: str | None = None, limit: int
 			):
 				top_doc_info = sorted_docs[0]
 				doc = frappe.get_doc(top_doc_info["doctype"], top_doc_info["name"])
-				doc_dict = json.loads(frappe.as_json(doc))
+				doc_dict = _doc_to_json_dict(doc)
 				context = f"Found a confident match for '{query}': {top_doc_info['label']} (ID: {top_doc_info['name']}, Type: {top_doc_info['doctype']}).\n\nFull details:\n"
 				for field, value in doc_dict.items():
 					if value and not isinstance(value, list):
@@ -897,6 +937,86 @@ def get_drive_file_context(file_id: str) -> str:
 get_drive_file_context.service = "drive"
 
 
+def get_drive_file_version(file_id, credentials=None):
+	"""Returns the version of a Drive file, which changes whenever the file does.
+
+	Args:
+	    file_id (str): The ID of the Google Drive file.
+	    credentials (google.oauth2.credentials.Credentials, optional): The user's
+	        credentials. Defaults to the current user's stored credentials.
+
+	Returns:
+	    str: The file's version, or None if the user cannot access the file.
+	"""
+	credentials = credentials or get_user_credentials()
+	if not credentials:
+		return None
+
+	try:
+		service = build("drive", "v3", credentials=credentials)
+		file_meta = service.files().get(fileId=file_id, fields="version", supportsAllDrives=True).execute()
+		return file_meta.get("version")
+	except HttpError as error:
+		frappe.log_error(
+			message=f"Google Drive API Error while reading the version of fileId {file_id}: {error.content}",
+			title="Gemini Google Drive Error",
+		)
+		return None
+
+
+def download_drive_file(file_id, credentials=None):
+	"""Downloads a Drive file into a spooled temporary file, chunk by chunk.
+
+	Files up to 8 MiB stay in memory; larger files are spilled to disk so the
+	worker never holds a multi-megabyte Drive file as a single bytes object.
+
+	Args:
+	    file_id (str): The ID of the Google Drive file.
+	    credentials (google.oauth2.credentials.Credentials, optional): The user's
+	        credentials. Defaults to the current user's stored credentials.
+
+	Returns:
+	    tuple: A ``(file_obj, file_name, mime_type)`` tuple with ``file_obj`` rewound
+	        to the start, or None if the file could not be downloaded.
+	"""
+	credentials = credentials or get_user_credentials()
+	if not credentials:
+		return None
+
+	try:
+		service = build("drive", "v3", credentials=credentials)
+		file_meta = (
+			service.files().get(fileId=file_id, fields="id, name, mimeType", supportsAllDrives=True).execute()
+		)
+		mime_type = file_meta.get("mimeType", "")
+		if "google-apps.document" in mime_type:
+			# Native Google Docs have no binary content; export them as plain text.
+			mime_type = "text/plain"
+			request = service.files().export_media(fileId=file_id, mimeType=mime_type)
+		else:
+			request = service.files().get_media(fileId=file_id, supportsAllDrives=True)
+
+		file_obj = tempfile.SpooledTemporaryFile(max_size=DRIVE_DOWNLOAD_SPOOL_SIZE)
+		try:
+			downloader = MediaIoBaseDownload(file_obj, request, chunksize=DRIVE_DOWNLOAD_CHUNK_SIZE)
+			done = False
+			while not done:
+				_status, done = downloader.next_chunk()
+			file_obj.seek(0)
+		except BaseException:
+			# A partly downloaded file may already be spilled to disk; remove it.
+			file_obj.close()
+			raise
+
+		return file_obj, file_meta.get("name", file_id), mime_type
+	except HttpError as error:
+		frappe.log_error(
+			message=f"Google Drive API Error while downloading fileId {file_id}: {error.content}",
+			title="Gemini Google Drive Error",
+		)
+		return None
+
+
 @mcp.tool()
 @log_activity
 @handle_errors
@@ -1614,8 +1734,8 @@ def find_similar_files(query_embedding, limit=5):
 		if not emb_info.get("embedding") or not isinstance(emb_info["embedding"], str):
 			continue
 		try:
-			stored_embedding = np.array(json.loads(emb_info["embedding"]))
-		except (json.JSONDecodeError, TypeError):
+			stored_embedding = np.array(orjson.loads(emb_info["embedding"]))
+		except orjson.JSONDecodeError:
 			continue
 
 		score = cosine_similarity(query_embedding, stored_embedding)
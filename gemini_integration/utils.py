@@ -1,12 +1,16 @@
 import functools
+import hashlib
 import traceback
+from datetime import datetime, timedelta, timezone
 
 import frappe
 import google.genai as genai
+import orjson
 from google.genai.errors import ServerError
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-from google.genai.types import EmbedContentConfig
+from google.genai.types import EmbedContentConfig, GenerateContentConfig
 from frappe.utils import get_site_url
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
@@ -91,8 +95,53 @@ def handle_errors(func):
 	return wrapper
 
 
-@log_activity
-@handle_errors
+def _run_with_site_context(site, sites_path, user, fn, args, kwargs):
+	"""Runs `fn` on a worker thread with its own Frappe context and database connection.
+
+	The worker's connection is not the request's, so its writes are committed here when
+	`fn` returns and rolled back if it raises.
+	"""
+	frappe.init(site=site, sites_path=sites_path)
+	try:
+		frappe.connect()
+		frappe.set_user(user)
+		result = fn(*args, **kwargs)
+		frappe.db.commit()
+		return result
+	except Exception:
+		if frappe.db:
+			frappe.db.rollback()
+		raise
+	finally:
+		frappe.destroy()
+
+
+def submit_with_site_context(executor, fn, *args, **kwargs):
+	"""Submits `fn` to a thread pool so it runs against the current site as the current user.
+
+	Frappe's request state (`frappe.local`, `frappe.db`) is not shared with new threads,
+	so each call is given its own site context and connection for the duration of the call.
+	Its writes are committed on that connection when it returns, independently of the
+	request's own transaction.
+
+	Args:
+	    executor (concurrent.futures.Executor): The executor to submit the call to.
+	    fn (function): The function to run.
+
+	Returns:
+	    concurrent.futures.Future: The future for the submitted call.
+	"""
+	return executor.submit(
+		_run_with_site_context,
+		frappe.local.site,
+		frappe.local.sites_path,
+		frappe.session.user,
+		fn,
+		args,
+		kwargs,
+	)
+
+
 def get_google_settings():
 	"""Retrieves Google settings from Social Login Keys.
 
@@ -105,73 +154,161 @@ def get_google_settings():
 	return settings
 
 
-@log_activity
-@handle_errors
+# Bumped whenever a Social Login Key is saved so every worker process drops its cached
+# Google client credentials.
+GOOGLE_SETTINGS_VERSION_CACHE_KEY = "gemini_google_settings_version"
+
+# Google OAuth client IDs and decrypted secrets by site, each with the settings version it was read at.
+_google_client_cache = {}
+
+
+def get_google_client_credentials():
+	"""Returns the OAuth client ID and decrypted client secret of the Google Social Login Key.
+
+	They are kept in process memory until a Social Login Key is saved again, so loading
+	a user's credentials does not reload the settings and decrypt the secret each time.
+
+	Returns:
+	    tuple: The ``(client_id, client_secret)`` pair.
+	"""
+	settings_version = frappe.cache().get_value(GOOGLE_SETTINGS_VERSION_CACHE_KEY)
+	cached = _google_client_cache.get(frappe.local.site)
+	if cached and cached[0] == settings_version:
+		return cached[1]
+
+	settings = get_google_settings()
+	client_credentials = (settings.client_id, settings.get_password("client_secret"))
+	_google_client_cache[frappe.local.site] = (settings_version, client_credentials)
+	return client_credentials
+
+
+def bump_google_settings_version(doc=None, method=None):
+	"""Invalidates the Google client credentials cached in every worker process."""
+	frappe.cache().set_value(GOOGLE_SETTINGS_VERSION_CACHE_KEY, frappe.generate_hash(length=10))
+
+
 def is_google_integrated():
 	"""Checks if a valid token exists for the current user.
 
+	The answer is cached per user until their Google User Token is saved or deleted.
+
 	Returns:
 	    bool: True if a token exists, False otherwise.
 	"""
-	return frappe.db.exists("Google User Token", {"user": frappe.session.user})
+	user = frappe.session.user
+	connected = frappe.cache().hget(GOOGLE_CONNECTED_CACHE_KEY, user)
+	if connected is None:
+		connected = bool(frappe.db.exists("Google User Token", {"user": user}))
+		frappe.cache().hset(GOOGLE_CONNECTED_CACHE_KEY, user, connected)
+	return connected
+
+
+# Whether each user has a Google User Token, so the check skips the database.
+GOOGLE_CONNECTED_CACHE_KEY = "gemini_google_connected"
+
+# Google User Token fields by user, read until the access token is about to expire.
+GOOGLE_CREDENTIALS_CACHE_KEY = "gemini_google_credentials"
+
+# Access tokens this close to their expiry are refreshed before they are handed out.
+GOOGLE_TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+
+def _is_google_token_fresh(token):
+	"""Checks that a stored access token has a known expiry that is not close."""
+	expiry = token and token.get("access_token_expiry")
+	if not expiry:
+		return False
+	return expiry - GOOGLE_TOKEN_REFRESH_MARGIN > datetime.now(timezone.utc).replace(tzinfo=None)
 
 
-@log_activity
-@handle_errors
 def get_user_credentials():
-	"""Retrieves stored credentials for the current user from the database.
+	"""Retrieves stored credentials for the current user.
+
+	The token fields are cached until the access token nears expiry, so repeated tool
+	calls skip the database. An expiring token is refreshed once here and stored, rather
+	than being refreshed again by every Google API call that uses it.
 
 	Returns:
 	    google.oauth2.credentials.Credentials: The user's credentials, or None if not found.
 	"""
-	if not is_google_integrated():
-		return None
+	user = frappe.session.user
 	try:
-		token_doc = frappe.get_doc("Google User Token", {"user": frappe.session.user})
-		return Credentials(
-			token=token_doc.access_token,
-			refresh_token=token_doc.refresh_token,
+		token = frappe.cache().hget(GOOGLE_CREDENTIALS_CACHE_KEY, user)
+		cached = _is_google_token_fresh(token)
+		if not cached:
+			token = frappe.db.get_value(
+				"Google User Token",
+				{"user": user},
+				["access_token", "refresh_token", "scopes", "access_token_expiry"],
+				as_dict=True,
+			)
+			if not token:
+				return None
+			# Kept as the granted scopes, which can differ from GOOGLE_SCOPES for older
+			# connections; split once here so cached tokens already hold the list.
+			token.scopes = token.scopes.split(" ") if token.scopes else []
+
+		client_id, client_secret = get_google_client_credentials()
+		credentials = Credentials(
+			token=token.access_token,
+			refresh_token=token.refresh_token,
 			token_uri="https://oauth2.googleapis.com/token",
-			client_id=get_google_settings().client_id,
-			client_secret=get_google_settings().get_password("client_secret"),
-			scopes=token_doc.scopes.split(" ") if token_doc.scopes else [],
+			client_id=client_id,
+			client_secret=client_secret,
+			scopes=token.scopes,
+			expiry=token.access_token_expiry,
 		)
+		if cached:
+			return credentials
+
+		if not _is_google_token_fresh(token) and credentials.refresh_token:
+			credentials.refresh(GoogleAuthRequest())
+			token.access_token = credentials.token
+			token.access_token_expiry = credentials.expiry
+			frappe.db.set_value(
+				"Google User Token",
+				{"user": user},
+				{"access_token": credentials.token, "access_token_expiry": credentials.expiry},
+				update_modified=False,
+			)
+		frappe.cache().hset(GOOGLE_CREDENTIALS_CACHE_KEY, user, token)
+		return credentials
 	except Exception as e:
 		frappe.log_error(f"Could not get user credentials: {e}", "Gemini Integration")
 		return None
 
 
-@log_activity
-@handle_errors
+# Scopes define the level of access to the user's Google data.
+GOOGLE_SCOPES = (
+	"https://www.googleapis.com/auth/userinfo.email",
+	"openid",
+	"https://www.googleapis.com/auth/gmail.modify",
+	"https://www.googleapis.com/auth/gmail.send",
+	"https://www.googleapis.com/auth/drive",
+	"https://www.googleapis.com/auth/calendar",
+	"https://www.googleapis.com/auth/contacts.readonly",
+)
+
+
 def get_google_flow():
 	"""Builds the Google OAuth 2.0 Flow object for authentication.
 
 	Returns:
 	    google_auth_oauthlib.flow.Flow: The configured Google OAuth 2.0 Flow object.
 	"""
-	settings = get_google_settings()
+	client_id, client_secret = get_google_client_credentials()
 	redirect_uri = (
 		get_site_url(frappe.local.site) + "/api/method/gemini_integration.api.handle_google_callback"
 	)
 	client_secrets = {
 		"web": {
-			"client_id": settings.client_id,
-			"client_secret": settings.get_password("client_secret"),
+			"client_id": client_id,
+			"client_secret": client_secret,
 			"auth_uri": "https://accounts.google.com/o/oauth2/auth",
 			"token_uri": "https://oauth2.googleapis.com/token",
 		}
 	}
-	# Scopes define the level of access to the user's Google data.
-	scopes = [
-		"https://www.googleapis.com/auth/userinfo.email",
-		"openid",
-		"https://www.googleapis.com/auth/gmail.modify",
-		"https://www.googleapis.com/auth/gmail.send",
-		"https://www.googleapis.com/auth/drive",
-		"https://www.googleapis.com/auth/calendar",
-		"https://www.googleapis.com/auth/contacts.readonly",
-	]
-	return Flow.from_client_config(client_secrets, scopes=scopes, redirect_uri=redirect_uri)
+	return Flow.from_client_config(client_secrets, scopes=list(GOOGLE_SCOPES), redirect_uri=redirect_uri)
 
 
 @log_activity
@@ -225,14 +362,16 @@ def process_google_callback(code, state, error):
 		google_email = user_info.get("email")
 
 		# Create or update the Google User Token document for the current user.
-		if frappe.db.exists("Google User Token", {"user": frappe.session.user}):
-			token_doc = frappe.get_doc("Google User Token", {"user": frappe.session.user})
+		token_name = frappe.db.get_value("Google User Token", {"user": frappe.session.user}, "name")
+		if token_name:
+			token_doc = frappe.get_doc("Google User Token", token_name)
 		else:
 			token_doc = frappe.new_doc("Google User Token")
 			token_doc.user = frappe.session.user
 
 		token_doc.google_email = google_email
 		token_doc.access_token = creds.token
+		token_doc.access_token_expiry = creds.expiry
 		if creds.refresh_token:
 			token_doc.refresh_token = creds.refresh_token
 		token_doc.scopes = " ".join(creds.scopes) if creds.scopes else ""
@@ -257,19 +396,59 @@ def process_google_callback(code, state, error):
 	)
 
 
+# Bumped by GeminiSettings.on_update so every worker process drops its cached settings.
+SETTINGS_VERSION_CACHE_KEY = "gemini_settings_version"
+
+# Decrypted API keys by site, each with the settings version it was read at.
+_api_key_cache = {}
+
+
+def get_gemini_api_key():
+	"""Returns the decrypted Gemini API key from Gemini Settings.
+
+	The key is kept in process memory until Gemini Settings is saved again, so a chat
+	turn costs one Redis read instead of loading and decrypting the settings.
+
+	Returns:
+	    str | None: The API key, or None if it is not set.
+	"""
+	settings_version = frappe.cache().get_value(SETTINGS_VERSION_CACHE_KEY)
+	cached = _api_key_cache.get(frappe.local.site)
+	if cached and cached[0] == settings_version:
+		return cached[1]
+
+	api_key = frappe.get_cached_doc("Gemini Settings").get_password("api_key", raise_exception=False)
+	_api_key_cache[frappe.local.site] = (settings_version, api_key)
+	return api_key
+
+
+def bump_settings_version():
+	"""Invalidates the settings cached in every worker process."""
+	frappe.cache().set_value(SETTINGS_VERSION_CACHE_KEY, frappe.generate_hash(length=10))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_client_for_key(api_key):
+	"""Returns the process-wide Gemini client for an API key, creating it on first use."""
+	return genai.Client(api_key=api_key)
+
+
 def get_gemini_client():
 	"""Creates and returns an authenticated Gemini client.
 
+	Clients are shared across requests and jobs in the same process, keyed by API key,
+	so calls reuse the client's pooled HTTP connections instead of opening new ones.
+
 	Returns:
 	    google.genai.Client: An initialized Gemini client, or None on failure.
 	"""
-	settings = frappe.get_single("Gemini Settings")
-	api_key = settings.get_password("api_key")
+	api_key = get_gemini_api_key()
 	if not api_key:
 		frappe.log_error("Gemini API Key not found in Gemini Settings.", "Gemini Integration")
 		return None
+
 	try:
-		return genai.Client(api_key=api_key)
+		return _get_client_for_key(api_key)
 	except Exception as e:
 		frappe.log_error(f"Failed to create Gemini client: {e!s}", "Gemini Integration")
 		return None
@@ -304,7 +483,72 @@ def generate_embedding(text):
 		return None
 
 
-def generate_text(prompt, model_name=None, uploaded_files=None):
+# The embedding endpoint accepts at most this many contents per request.
+EMBEDDING_BATCH_SIZE = 100
+
+
+@retry(
+	wait=wait_exponential(multiplier=1, min=2, max=60),
+	stop=stop_after_attempt(3),
+	retry=retry_if_exception_type(ServerError),
+)
+def _embed_batch(client, texts):
+	"""Embeds a single batch of texts with one API request."""
+	result = client.models.embed_content(
+		model="models/embedding-001",
+		contents=texts,
+		config=EmbedContentConfig(task_type="RETRIEVAL_DOCUMENT"),
+	)
+	return [embedding.values for embedding in result.embeddings or []]
+
+
+def embed_texts(client, texts):
+	"""
+	Embeds a list of texts with the given client, EMBEDDING_BATCH_SIZE texts per request.
+	This makes no Frappe calls, so it is safe to run on a worker thread.
+
+	Returns:
+	    list: One vector per input text, in order.
+
+	Raises:
+	    ValueError: If the API returns a different number of vectors than texts.
+	"""
+	vectors = []
+	for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+		vectors.extend(_embed_batch(client, texts[start : start + EMBEDDING_BATCH_SIZE]))
+	if len(vectors) != len(texts):
+		raise ValueError(f"Expected {len(texts)} embeddings but received {len(vectors)}.")
+	return vectors
+
+
+def generate_embeddings(texts):
+	"""
+	Generates embeddings for a list of texts, sending them in batches rather than
+	one request per text.
+
+	Returns:
+	    list | None: One vector per input text, in order, or None on failure.
+	"""
+	if not texts:
+		return []
+	client = get_gemini_client()
+	if not client:
+		return None
+	try:
+		return embed_texts(client, texts)
+	except Exception as e:
+		frappe.log_error(
+			message=f"Failed to generate embeddings: {e!s}\n{frappe.get_traceback()}",
+			title="Gemini Embedding Generation Error",
+		)
+		return None
+
+
+# How long a parsed generate_json reply is reused for an identical prompt.
+GENERATED_TEXT_CACHE_TTL = 3 * 60 * 60
+
+
+def generate_text(prompt, model_name=None, uploaded_files=None, config=None):
 	"""Generates text using a specified Gemini model.
 
 	Args:
@@ -314,6 +558,8 @@ def generate_text(prompt, model_name=None, uploaded_files=None):
 	        Defaults to None.
 	    uploaded_files (list, optional): A list of uploaded files to include
 	        in the context. Defaults to None.
+	    config (google.genai.types.GenerateContentConfig, optional): Generation settings
+	        passed to the model. Defaults to None.
 
 	Returns:
 	    str: The generated text from the model.
@@ -332,7 +578,8 @@ def generate_text(prompt, model_name=None, uploaded_files=None):
 
 		response = client.models.generate_content(
 			model=model_name,
-			contents=contents
+			contents=contents,
+			config=config,
 		)
 		try:
 			return response.text
@@ -345,3 +592,43 @@ def generate_text(prompt, model_name=None, uploaded_files=None):
 		frappe.throw(
 			"An error occurred while communicating with the Gemini API. Please check the Error Log for details."
 		)
+
+
+def generate_json(prompt, schema, model_name=None, cache=False):
+	"""Generates a JSON value that follows `schema` using Gemini's structured output.
+
+	When `cache` is set, only a reply that parsed successfully is stored, so a truncated
+	reply is never replayed to later calls.
+
+	Args:
+	    prompt (str): The text prompt for the model.
+	    schema (dict): The OpenAPI-style schema the response must match.
+	    model_name (str, optional): The name of the model to use. Defaults to None.
+	    cache (bool, optional): Whether to reuse the parsed response to an identical
+	        earlier prompt for the same model and schema. Defaults to False.
+
+	Returns:
+	    The parsed JSON value, or None if the model returned no text.
+
+	Raises:
+	    orjson.JSONDecodeError: If the response was cut off before the JSON was complete.
+	"""
+	if not model_name:
+		model_name = frappe.db.get_single_value("Gemini Settings", "default_model") or "gemini-3-pro-preview"
+	config = GenerateContentConfig(response_mime_type="application/json", response_schema=schema)
+
+	cache_key = None
+	if cache:
+		key_source = f"{model_name}\0{config.model_dump_json(exclude_none=True)}\0{prompt}"
+		cache_key = f"gemini_generated_json:{hashlib.sha256(key_source.encode()).hexdigest()}"
+		cached_value = frappe.cache().get_value(cache_key)
+		if cached_value is not None:
+			return cached_value
+
+	response_text = generate_text(prompt, model_name=model_name, config=config)
+	if not response_text:
+		return None
+	value = orjson.loads(response_text)
+	if cache_key:
+		frappe.cache().set_value(cache_key, value, expires_in_sec=GENERATED_TEXT_CACHE_TTL)
+	return value